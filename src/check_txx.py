@@ -21,8 +21,11 @@ import matplotlib.pyplot as plt
 import pandas as pd
 
 import constants as c
+from qc import pack_qc, qc_mask
+from flux_io import read_nc, FLUX_VARS, MET_VARS
+from event_engine import load_daily_product
 
-def main(flux_dir):
+def main(flux_dir, product_dir=None):
 
     sites = ["AdelaideRiver","Calperum","CapeTribulation","CowBay",\
              "CumberlandPlains","DalyPasture","DalyUncleared",\
@@ -48,19 +51,25 @@ def main(flux_dir):
 
 
     for flux_fn, met_fn in zip(flux_files, met_files):
-        (site, df_flx, df_met) = open_file(flux_fn, met_fn)
-        #print(site)
+        if product_dir is None:
+            (site, df_flx, df_met) = open_file(flux_fn, met_fn)
+            #print(site)
 
-        # daylight hours
-        df_flx = df_flx.between_time("06:00", "20:00")
-        df_met = df_met.between_time("06:00", "20:00")
+            # daylight hours
+            df_flx = df_flx.between_time("06:00", "20:00")
+            df_met = df_met.between_time("06:00", "20:00")
 
-        (df_flx, df_met) = mask_crap_days(df_flx, df_met)
-        df_met.Tair -= c.DEG_2_KELVIN
+            (df_flx, df_met) = mask_crap_days(df_flx, df_met)
 
-        (Txx) = get_hottest_day(df_flx, df_met)
+            (Txx) = get_hottest_day(df_flx, df_met)
+            yrs = np.unique(df_flx.index.year).tolist()
+        else:
+            site = os.path.basename(flux_fn).split("OzFlux")[0]
+            daily = load_daily_product(product_dir, flux_fn, met_fn,
+                                       qc_policy="ozflux_qle")
+            Txx = daily.Tair.max()
+            yrs = np.unique(daily.index.year).tolist()
 
-        yrs = np.unique(df_flx.index.year).tolist()
         yrs = ' '.join(str(e) for e in yrs)
 
         print(site, d[site], round(Txx, 2), yrs)
@@ -76,36 +85,15 @@ def get_hottest_day(df_flx, df_met):
 
 
 def mask_crap_days(df_flx, df_met):
-    # Mask crap stuff
-    df_flx.where(df_flx.Qle_qc == 1, inplace=True)
-    df_flx.where(df_met.Tair_qc == 1, inplace=True)
+    # Mask crap stuff and dew, one combined mask applied once to each frame
+    good = qc_mask(pack_qc(df_flx, df_met), "ozflux_qle")
 
-    df_met.where(df_flx.Qle_qc == 1, inplace=True)
-    df_met.where(df_met.Tair_qc == 1, inplace=True)
-
-    # Mask dew
-    df_met.where(df_flx.Qle > 0., inplace=True)
-    df_flx.where(df_flx.Qle > 0., inplace=True)
-
-    df_met = df_met.reset_index()
-    df_met = df_met.set_index('time')
-    df_flx = df_flx.reset_index()
-    df_flx = df_flx.set_index('time')
-
-    return df_flx, df_met
+    return df_flx.where(good), df_met.where(good)
 
 def open_file(flux_fn, met_fn):
     site = os.path.basename(flux_fn).split("OzFlux")[0]
-    ds = xr.open_dataset(flux_fn)
-    df_flx = ds.squeeze(dim=["x","y"], drop=True).to_dataframe()
-    ds = xr.open_dataset(met_fn)
-    df_met = ds.squeeze(dim=["x","y"], drop=True).to_dataframe()
-
-    df_met = df_met.reset_index()
-    df_met = df_met.set_index('time')
-
-    df_flx = df_flx.reset_index()
-    df_flx = df_flx.set_index('time')
+    df_flx = read_nc(flux_fn, FLUX_VARS, canonical=True)
+    df_met = read_nc(met_fn, MET_VARS, canonical=True)
 
     return (site, df_flx, df_met)
 
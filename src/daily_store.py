@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+Keep each site's daily series and events on disk between runs.
+
+Alongside the daily series (pickled) we store, as json, a fingerprint of the
+input files (path, size, mtime), the time span the met file covered and the
+settings the events were extracted with. On a rerun:
+
+* nothing changed -> reuse the stored events, no files are opened;
+* only the settings changed -> re-extract events from the stored daily series;
+* the files grew at the end (a new quarter/year appended, same start) -> re-read
+  just the trailing period, from the last stored day on, splice it onto the
+  stored series and redo the events. The event walk over the daily series is
+  cheap, so redoing all of it also picks up any event near the join;
+* anything else -> start again from scratch.
+
+Note an in-place revision of older data that keeps the same time span will look
+like an append, in that case clear the store.
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import os
+import sys
+import json
+import numpy as np
+import xarray as xr
+import pandas as pd
+
+def fingerprint(fnames):
+    """ Path, size and modification time of each input file """
+    return [[os.path.abspath(fn), os.path.getsize(fn), os.path.getmtime(fn)]
+            for fn in fnames if fn is not None]
+
+def get_time_span(fname):
+    """ First and last time in a file, reading only the time coordinate """
+    ds = xr.open_dataset(fname)
+    time = ds.time.values
+    ds.close()
+
+    return [str(time[0]), str(time[-1])]
+
+def is_appended(meta, span):
+    """
+    Same start, and runs on past what we've got stored. A file that has
+    changed over the same span has had its history revised, so is rebuilt
+    """
+    return (meta["span"][0] == span[0] and
+            np.datetime64(span[1]) > np.datetime64(meta["span"][1]))
+
+def load(store_dir, key):
+    """ Stored (meta, daily, events) for a site, Nones if we haven't one """
+    meta_fn = os.path.join(store_dir, "%s.json" % (key))
+    if not os.path.exists(meta_fn):
+        return (None, None, None)
+
+    with open(meta_fn, "r") as f:
+        meta = json.load(f)
+
+    daily_fn = os.path.join(store_dir, "%s_daily.pkl" % (key))
+    events_fn = os.path.join(store_dir, "%s_events.pkl" % (key))
+    daily = pd.read_pickle(daily_fn) if os.path.exists(daily_fn) else None
+    events = pd.read_pickle(events_fn) if os.path.exists(events_fn) else None
+
+    return (meta, daily, events)
+
+def save(store_dir, key, meta, daily=None, events=None):
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    # Data first, so a run killed half way leaves a stale fingerprint behind
+    # rather than a fresh one pointing at old data
+    for (obj, name) in ((daily, "daily"), (events, "events")):
+        fn = os.path.join(store_dir, "%s_%s.pkl" % (key, name))
+        if obj is not None:
+            obj.to_pickle(fn)
+        elif os.path.exists(fn):
+            os.remove(fn)
+
+    with open(os.path.join(store_dir, "%s.json" % (key)), "w") as f:
+        json.dump(meta, f)
+
+def splice(daily, daily_tail):
+    """ Stored days before the tail starts, then the tail """
+    if len(daily_tail) == 0:
+        return daily
+    return pd.concat([daily[daily.index < daily_tail.index[0]], daily_tail])
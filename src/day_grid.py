@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Half-hourly (or hourly) data laid out as [n_days, steps_per_day] arrays.
+
+On a regular time axis that runs midnight to midnight each column is simply
+reshaped, no copy, otherwise the samples are placed into a NaN padded array.
+Daily max, mean, sum and counts are then reductions along axis 1, which give
+the same answers as resample("D") (an empty day is NaN, or zero for sums and
+counts), and a time of day window, e.g. daylight (06-20) or midday (09-13),
+is a slice of columns rather than a between_time copy of the frame.
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from flux_io import get_timestep
+
+# Windows of the day we use, inclusive at both ends as between_time
+DAYLIGHT = ("06:00", "20:00")
+MIDDAY = ("09:00", "13:00")
+
+SEC_2_DAY = 86400.
+
+class DayGrid(object):
+    """
+    Where each sample of a time index goes on a [n_days, steps_per_day]
+    grid. The days run from the first to the last day of the index
+    """
+
+    def __init__(self, index, timestep=None):
+        if timestep is None:
+            timestep = get_timestep(index)
+        self.timestep = timestep
+        self.nsteps = int(round(SEC_2_DAY / timestep))
+
+        day = index.normalize()
+        self.days = pd.date_range(day[0], day[-1], freq="D", name=index.name)
+        self.ndays = len(self.days)
+
+        row = (day - day[0]).days.values
+        col = ((index - day).total_seconds().values // timestep).astype(int)
+        pos = row * self.nsteps + col
+
+        # i.e. no gaps, so we can just reshape
+        self.regular = (len(pos) == self.ndays * self.nsteps and
+                        np.array_equal(pos, np.arange(len(pos))))
+        self.pos = None if self.regular else pos
+
+    def layout(self, x, fill=np.nan):
+        """ Values on the index as a [n_days, steps_per_day] array """
+        x = np.asarray(x)
+        if self.regular:
+            return x.reshape(self.ndays, self.nsteps)
+
+        dtype = np.result_type(x.dtype, np.min_scalar_type(fill))
+        out = np.full(self.ndays * self.nsteps, fill, dtype=dtype)
+        out[self.pos] = x
+
+        return out.reshape(self.ndays, self.nsteps)
+
+    def hours(self, window):
+        """ Slice of columns for a (start, end) time of day, e.g. DAYLIGHT """
+        (start, end) = [pd.Timedelta(t + ":00").total_seconds()
+                        for t in window]
+
+        return slice(int(np.ceil(start / self.timestep)),
+                     int(np.floor(end / self.timestep)) + 1)
+
+    def series(self, daily):
+        """ A daily reduction as a Series on the days """
+        return pd.Series(daily, index=self.days)
+
+def daily_count(x):
+    return np.sum(~np.isnan(x), axis=1)
+
+def daily_max(x):
+    """ NaN for a day without a valid sample, as resample("D").max() """
+    return np.fmax.reduce(x, axis=1)
+
+def daily_sum(x):
+    """ Zero for a day without a valid sample, as resample("D").sum() """
+    return np.nansum(x, axis=1)
+
+def daily_mean(x):
+    n = daily_count(x)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = daily_sum(x) / n
+
+    return np.where(n > 0, mean, np.nan)
@@ -0,0 +1,711 @@
+#!/usr/bin/env python
+
+"""
+Shared event extraction for the OzFlux/FLUXNET2015 (and CABLE) sites.
+
+Each site is opened once, masked, resampled to daily values once and then
+every requested variable is pulled out for the heatwave windows. Variables are
+looked up in VARIABLES (a daily aggregate of a column in one of the site's
+frames) or DERIVED (built from other variables, e.g. the Bowen ratio), so
+adding a new flux is a one line change.
+
+Running this script writes the observed and, if we have them, the CABLE events
+for every site into a single table, i.e. one read per site rather than one per
+analysis script. Given a store_dir, each site's daily series and events are
+kept between runs (see daily_store.py) and only sites whose files changed are
+re-read.
+
+Given a product_dir, each site's full daily product (get_daily_product) is
+kept on disk too, one per QC policy, so any script after the same daily values
+can start from it instead of re-masking and re-resampling the half-hourly data.
+
+With chunk set (a pandas frequency, "YS" for calendar years) each site is
+read, masked and reduced to its daily product a chunk at a time, so peak
+memory is set by the chunk rather than the length of the record.
+
+Sites are independent, so with nworkers > 1 they are farmed out to a pool of
+processes. Results are gathered back in manifest order, so the output is the
+same as a serial run.
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import os
+import sys
+import glob
+import functools
+import itertools
+import numpy as np
+import xarray as xr
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+import constants as c
+import daily_store
+from flux_io import read_nc, read_site_info, get_manifest, get_chunks
+from flux_io import CACHE_DIR, FLUX_VARS, MET_VARS, MOD_VARS
+from qc import pack_qc, qc_mask
+from day_grid import DayGrid, DAYLIGHT
+from day_grid import daily_count, daily_max, daily_mean, daily_sum
+from heatwave_events import DayIndex, WindowStats, EventSelector
+from heatwave_events import find_events, is_event_long_enough
+
+# name: (frame, column, daily aggregation)
+VARIABLES = {"Qle": ("flx", "Qle", "mean"),
+             "Qh": ("flx", "Qh", "mean"),
+             "GPP": ("flx", "GPP", "sum"),
+             "Qle_mod": ("mod", "Qle", "mean"),
+             "Qh_mod": ("mod", "Qh", "mean"),
+             "GPP_mod": ("mod", "GPP", "sum")}
+
+# name: (function of the daily values, variables it needs)
+DERIVED = {"B": (lambda v: v["Qh"] / v["Qle"], ["Qh", "Qle"]),
+           "B_mod": (lambda v: v["Qh_mod"] / v["Qle_mod"],
+                     ["Qh_mod", "Qle_mod"])}
+
+# PFTs we pull events out for
+OZFLUX_PFTS = ["EBF", "SAV", "TRF"]
+FLUXNET_PFTS = ["EBF", "ENF", "DBF"]
+
+def main(flux_dir, ofname, oz_flux=True, cable_dir=None, windows=[4],
+         tthreshs=[37.0], rain_thresholds=[0.2], store_dir=None,
+         product_dir=None, nworkers=1, compact=False, qc_policy=None,
+         chunk=None):
+
+    # Which sites we want is known from the file headers alone
+    if oz_flux:
+        manifest = get_manifest(flux_dir, oz_flux=oz_flux, cable_dir=cable_dir,
+                                pfts=get_ozflux_pfts())
+        manifest = manifest[manifest.pft.isin(OZFLUX_PFTS)]
+    else:
+        manifest = get_manifest(flux_dir, oz_flux=oz_flux, cable_dir=cable_dir)
+        manifest = manifest[manifest.pft.isin(FLUXNET_PFTS)]
+
+    variables = ["Qle", "B", "GPP"]
+    if cable_dir is not None:
+        variables += ["Qle_mod", "B_mod", "GPP_mod"]
+
+    output_dir = "outputs"
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    settings = {"windows": list(windows), "tthreshs": list(tthreshs),
+                "rain_thresholds": list(rain_thresholds)}
+
+    cols = (['site','pft','temp'] + variables +
+            ['window','Tthresh','rain_thresh'])
+    func = functools.partial(run_site, variables=variables, settings=settings,
+                             oz_flux=oz_flux, store_dir=store_dir,
+                             product_dir=product_dir, compact=compact,
+                             qc_policy=qc_policy, chunk=chunk)
+    results = map_sites(func, list(manifest.flux_fn), list(manifest.met_fn),
+                        list(manifest.cable_fn), nworkers=nworkers)
+
+    sink = EventWriter(os.path.join(output_dir, ofname), cols)
+    for (site, pft, dfx) in results:
+        if dfx is not None:
+            dfx = dfx.rename(columns={"Tair": "temp"})
+            dfx.insert(0, "site", site)
+            dfx.insert(1, "pft", pft)
+            if compact:
+                dfx = compact_events(dfx)
+            sink.write(dfx)
+    sink.close()
+
+def compact_events(df):
+    """ float32 values and categorical site/pft, e.g. for a parquet output """
+    df = df.astype({col: np.float32 for col in df.columns
+                    if df[col].dtype == np.float64})
+    df["site"] = df["site"].astype("category")
+    df["pft"] = df["pft"].astype("category")
+
+    return df
+
+class EventWriter(object):
+    """
+    Writes each site's events to the csv as we get them, rather than growing
+    one frame of every site (a copy per site) and writing it at the end. If
+    fname ends in .parquet each site goes in as a row group instead, with
+    categorical columns (see compact_events) stored dictionary encoded.
+    """
+
+    def __init__(self, fname, cols):
+        self.cols = cols
+        self.parquet = fname.endswith(".parquet")
+        if self.parquet:
+            self.fname = fname
+            self.writer = None
+        else:
+            self.f = open(fname, "w")
+            pd.DataFrame(columns=cols).to_csv(self.f, index=False)
+
+    def write(self, df):
+        if not self.parquet:
+            df[self.cols].to_csv(self.f, header=False, index=False)
+            return
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(df[self.cols], preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.fname, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if not self.parquet:
+            self.f.close()
+        elif self.writer is not None:
+            self.writer.close()
+
+def map_sites(func, *iterables, nworkers=1):
+    """ func over the sites, on nworkers processes, results in input order """
+    if nworkers <= 1:
+        for result in map(func, *iterables):
+            yield result
+    else:
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            for result in pool.map(func, *iterables):
+                yield result
+
+def run_site(flux_fn, met_fn, cable_fn, variables, settings, oz_flux=True,
+             store_dir=None, product_dir=None, compact=False,
+             qc_policy=None, chunk=None):
+    """ Everything for one site: returns the site, PFT and its events """
+    if store_dir is not None:
+        return update_site(store_dir, flux_fn, met_fn, cable_fn, variables,
+                           settings, oz_flux=oz_flux, product_dir=product_dir,
+                           compact=compact, qc_policy=qc_policy, chunk=chunk)
+
+    (site, pft,
+     daily) = get_site_daily(flux_fn, met_fn, cable_fn, variables,
+                             oz_flux=oz_flux, product_dir=product_dir,
+                             compact=compact, qc_policy=qc_policy,
+                             chunk=chunk)
+    dfx = None
+    if daily is not None:
+        dfx = sweep_events(daily_to_stats(daily), variables, **settings)
+
+    return (site, pft, dfx)
+
+def get_site_daily(flux_fn, met_fn, cable_fn, variables, oz_flux=True,
+                   start=None, product_dir=None, compact=False,
+                   qc_policy=None, chunk=None):
+    """
+    Daily series of the variables for a site. Returns the site, PFT and its
+    daily series, the latter None if it isn't a PFT we're interested in. If
+    start is given, only data from that date on are read, otherwise we go via
+    the daily product in product_dir if we have one. compact reads the data
+    as float32 (see flux_io.compact_frame), qc_policy picks one of
+    qc.POLICIES, by default that of the network, and chunk reads the files a
+    chunk at a time (see build_daily_product).
+    """
+    if oz_flux:
+        site = os.path.basename(flux_fn).split("OzFlux")[0]
+        pft = get_ozflux_pfts()[site]
+        keep = OZFLUX_PFTS
+    else:
+        (pft, site) = read_site_info(flux_fn)
+        keep = FLUXNET_PFTS
+
+    if pft not in keep:
+        return (site, pft, None)
+
+    if start is None and product_dir is not None:
+        product = load_daily_product(product_dir, flux_fn, met_fn, cable_fn,
+                                     oz_flux=oz_flux, compact=compact,
+                                     qc_policy=qc_policy, chunk=chunk)
+    else:
+        product = build_daily_product(flux_fn, met_fn, cable_fn,
+                                      oz_flux=oz_flux, start=start,
+                                      compact=compact, qc_policy=qc_policy,
+                                      chunk=chunk)
+    print(site, np.unique(product.index.year))
+
+    return (site, pft, product[daily_columns(variables)])
+
+def build_daily_product(flux_fn, met_fn, cable_fn=None, oz_flux=True,
+                        start=None, compact=False, qc_policy=None, chunk=None):
+    """
+    A site's daily product straight from its files. Given chunk (e.g. "YS",
+    see flux_io.get_chunks) the files are read, masked and reduced a chunk at
+    a time, bypassing the read cache, so only the daily product is ever held
+    for the whole record.
+    """
+    if chunk is None:
+        (frames, good) = get_site_frames(flux_fn, met_fn, cable_fn,
+                                         oz_flux=oz_flux, start=start,
+                                         compact=compact, qc_policy=qc_policy)
+        return get_daily_product(frames, good, hours=DAYLIGHT)
+
+    pieces = []
+    for (lo, hi) in get_chunks(met_fn, freq=chunk, start=start):
+        (frames, good) = get_site_frames(flux_fn, met_fn, cable_fn,
+                                         oz_flux=oz_flux, start=lo, end=hi,
+                                         compact=compact, qc_policy=qc_policy,
+                                         cache_dir=None)
+        pieces.append(get_daily_product(frames, good, hours=DAYLIGHT))
+        del frames, good
+
+    return join_daily(pieces)
+
+def join_daily(pieces):
+    """
+    One daily product from those of consecutive chunks. Days no chunk had
+    any data for are put back as they would be from one read, i.e. no valid
+    samples: counts, rain and daily sums of zero, everything else missing.
+    Chunks with no days are dropped, if they all are the product is empty
+    """
+    product = pd.concat([piece for piece in pieces if len(piece) > 0] or
+                        pieces[:1])
+    if len(product) == 0:
+        return product
+    days = pd.date_range(product.index[0], product.index[-1], freq="D",
+                         name=product.index.name)
+    if len(days) == len(product):
+        return product
+
+    zero = [col for col in product.columns
+            if col == "rain" or col.startswith("n_") or
+            (col in VARIABLES and VARIABLES[col][2] == "sum")]
+    gap = ~days.isin(product.index)
+    dtypes = product.dtypes
+    product = product.reindex(days)
+    product.loc[gap, zero] = 0
+
+    return product.astype(dtypes)
+
+def get_site_frames(flux_fn, met_fn, cable_fn=None, oz_flux=True, start=None,
+                    compact=False, qc_policy=None, end=None,
+                    cache_dir=CACHE_DIR):
+    """
+    Frames for a site with Tair in deg C, and the QA mask to go with them
+    (True where the data are good). The daylight hours are picked out as the
+    daily product is made, see get_daily_product
+    """
+    (site, frames,
+     pft, site_name) = open_site(flux_fn, met_fn, cable_fn, oz_flux=oz_flux,
+                                 start=start, compact=compact, end=end,
+                                 cache_dir=cache_dir)
+
+    good = mask_crap_days(frames, oz_flux=oz_flux, policy=qc_policy)
+
+    return (frames, good)
+
+def load_daily_product(product_dir, flux_fn, met_fn, cable_fn=None,
+                       oz_flux=True, compact=False, qc_policy=None,
+                       chunk=None):
+    """
+    A site's daily product from product_dir, (re)building and storing it if
+    we haven't got one for these files. Each QC policy (and compact) keeps
+    its own, so scripts after different masks can share product_dir
+    """
+    key = product_key(flux_fn, oz_flux=oz_flux, compact=compact,
+                      qc_policy=qc_policy)
+    fp = daily_store.fingerprint([flux_fn, met_fn, cable_fn])
+    (meta, product, _) = daily_store.load(product_dir, key)
+
+    if (meta is None or product is None or meta["fingerprint"] != fp or
+        meta["oz_flux"] != oz_flux or meta.get("compact", False) != compact or
+        meta.get("qc_policy") != qc_policy):
+        product = build_daily_product(flux_fn, met_fn, cable_fn,
+                                      oz_flux=oz_flux, compact=compact,
+                                      qc_policy=qc_policy, chunk=chunk)
+        meta = {"fingerprint": fp, "oz_flux": oz_flux, "compact": compact,
+                "qc_policy": qc_policy,
+                "timestep": product.attrs.get("timestep")}
+        daily_store.save(product_dir, key, meta, daily=product)
+
+    return product
+
+def product_key(flux_fn, oz_flux=True, compact=False, qc_policy=None):
+    """ Store key of a site's daily product, e.g. WhrooOzFlux_flux_ozflux """
+    if qc_policy is None:
+        qc_policy = "ozflux" if oz_flux else "fluxnet"
+    key = "%s_%s" % (os.path.basename(flux_fn).replace(".nc", ""), qc_policy)
+
+    return key + "_compact" if compact else key
+
+def update_site(store_dir, flux_fn, met_fn, cable_fn, variables, settings,
+                oz_flux=True, product_dir=None, compact=False, qc_policy=None,
+                chunk=None):
+    """
+    As get_site_daily + sweep_events, but going via the daily store so we only
+    re-read what has changed since the last run.
+    """
+    key = os.path.basename(flux_fn).replace(".nc", "")
+    fp = daily_store.fingerprint([flux_fn, met_fn, cable_fn])
+    (meta, daily, events) = daily_store.load(store_dir, key)
+    same_read = (meta is not None and meta["variables"] == variables and
+                 meta["oz_flux"] == oz_flux and
+                 meta.get("compact", False) == compact and
+                 meta.get("qc_policy") == qc_policy)
+
+    if same_read:
+
+        if meta["fingerprint"] == fp:
+            if daily is None:
+                # Not a PFT we want, nothing to do
+                return (meta["site"], meta["pft"], None)
+            if meta["settings"] == settings and events is not None:
+                return (meta["site"], meta["pft"], events)
+
+            # Same data, new thresholds/windows
+            events = sweep_events(daily_to_stats(daily), variables,
+                                  **settings)
+            meta["settings"] = settings
+            daily_store.save(store_dir, key, meta, daily, events)
+
+            return (meta["site"], meta["pft"], events)
+
+    span = daily_store.get_time_span(met_fn)
+    if same_read and daily is not None and daily_store.is_appended(meta,
+                                                                   span):
+        # Re-read from the start of the last day we've got, it may have only
+        # been part way through
+        start = daily.index[-1]
+        (site, pft,
+         daily_tail) = get_site_daily(flux_fn, met_fn, cable_fn, variables,
+                                      oz_flux=oz_flux, start=start,
+                                      compact=compact, qc_policy=qc_policy,
+                                      chunk=chunk)
+        daily = daily_store.splice(daily, daily_tail)
+    else:
+        (site, pft,
+         daily) = get_site_daily(flux_fn, met_fn, cable_fn, variables,
+                                 oz_flux=oz_flux, product_dir=product_dir,
+                                 compact=compact, qc_policy=qc_policy,
+                                 chunk=chunk)
+
+    events = None
+    if daily is not None:
+        events = sweep_events(daily_to_stats(daily), variables, **settings)
+
+    meta = {"site": site, "pft": pft, "fingerprint": fp, "span": span,
+            "variables": variables, "oz_flux": oz_flux, "compact": compact,
+            "qc_policy": qc_policy, "settings": settings}
+    daily_store.save(store_dir, key, meta, daily, events)
+
+    return (site, pft, events)
+
+def get_daily_stats(frames, variables):
+    """
+    Daily max Tair, rain (mm d-1) and the daily aggregate of every variable
+    we need (including those DERIVED ones need) as running totals
+    """
+    return daily_to_stats(get_daily(frames, variables))
+
+def daily_to_stats(daily):
+    """ Running totals of each column of a daily frame """
+    series = {col: daily[col].values for col in daily.columns}
+
+    return WindowStats(days=DayIndex(daily.index), **series)
+
+def get_daily(frames, variables):
+    """
+    Daily max Tair, rain (mm d-1) and the daily aggregate of every variable
+    we need (including those DERIVED ones need), on the grid of the Tair
+    """
+    return get_daily_product(frames)[daily_columns(variables)]
+
+def daily_columns(variables):
+    """ Columns of the daily product the variables need """
+    cols = ["Tair", "rain"]
+    for var in variables:
+        if var in DERIVED:
+            cols += [v for v in DERIVED[var][1] if v not in cols]
+        elif var not in cols:
+            cols.append(var)
+
+    return cols
+
+def get_daily_product(frames, good=None, hours=None):
+    """
+    Everything we want by day out of a site's (daylight, QA'd) frames, in
+    analysis units (see flux_io.canonicalize): max (Tair) and mean
+    (Tair_mean) temperature, rain (mm d-1), the daily aggregate of each of
+    the VARIABLES we've got a frame for, and as n_<name> the number of valid
+    samples that went into each day. Note a day with no valid samples sums to
+    zero (GPP, rain), so check the counts.
+
+    If we're handed the QA mask (good) the frames haven't been masked, and it
+    is applied to just the columns we aggregate as we go. Given hours, a
+    (start, end) time of day such as day_grid.DAYLIGHT, only that part of
+    each day is used.
+
+    Each column is laid out as [days, timesteps] (see day_grid.py), so the
+    daily aggregates are reductions along the rows and hours is a slice of
+    the columns.
+    """
+    grids = {}
+
+    def get_grid(key):
+        if key not in grids:
+            index = frames[key].index
+            if key != "met" and index.equals(frames["met"].index):
+                grids[key] = get_grid("met")
+            else:
+                grids[key] = DayGrid(index, frames[key].attrs.get("timestep"))
+        return grids[key]
+
+    def column(key, col):
+        df = frames[key]
+        x = df[col].values
+        if good is not None:
+            if good.index.equals(df.index):
+                mask = good.values
+            else:
+                mask = good.reindex(df.index, fill_value=False).values
+            x = np.where(mask, x, np.nan)
+
+        grid = get_grid(key)
+        x = grid.layout(x)
+        return x if hours is None else x[:, grid.hours(hours)]
+
+    # Everything is held on the grid of the daily Tair, i.e. the days we
+    # have any met for (in hours)
+    grid = get_grid("met")
+    have = grid.layout(np.ones(len(frames["met"])), fill=0.)
+    if hours is not None:
+        have = have[:, grid.hours(hours)]
+    have = np.flatnonzero(have.any(axis=1))
+    if len(have) == 0:
+        # e.g. a chunk holding just the midnight stamp closing the record
+        rows = slice(0, 0)
+    else:
+        rows = slice(have[0], have[-1] + 1)
+
+    tair = column("met", "Tair")[rows]
+    dates = grid.days[rows]
+    days = DayIndex(dates)
+    product = {"Tair": daily_max(tair), "Tair_mean": daily_mean(tair),
+               "n_Tair": daily_count(tair)}
+
+    # We need to figure out if it rained during our hot extreme as this
+    # would change the Qle in the way we're searching for!
+    product["rain"] = daily_sum(column("met", "Rainf")[rows])
+
+    for var, (key, col, how) in VARIABLES.items():
+        if key not in frames:
+            continue
+
+        x = column(key, col)
+        if how == "mean":
+            daily = daily_mean(x)
+        elif how == "sum":
+            daily = daily_sum(x)
+        else:
+            daily = daily_max(x)
+        series = get_grid(key).series
+        product[var] = on_grid(days, series(daily))
+        product["n_%s" % (var)] = on_grid(days, series(daily_count(x)),
+                                          fill=0)
+
+    product = pd.DataFrame(product, index=dates)
+    product.attrs["timestep"] = frames["met"].attrs.get("timestep")
+
+    return product
+
+def on_grid(days, daily, fill=np.nan):
+    """ Values of a daily series at the days of the grid. Usually the series
+    is already on the grid and we just hand back its values, but the model
+    output needn't start/end on the same day as the met """
+    if days.ndays == 0:
+        return np.full(0, fill)
+    if len(daily) == days.ndays and days.offset(daily.index[0]) == 0:
+        return daily.values
+
+    dates = daily.index.values.astype("datetime64[D]")
+    pos = days.offsets(dates)
+    ok = (pos >= 0) & (pos < days.ndays)
+    ok[ok] = days.days[pos[ok]] == dates[ok]
+
+    x = np.full(days.ndays, fill)
+    x[pos[ok]] = daily.values[ok]
+
+    return x
+
+def get_values(stats, variables, idx, window):
+    """ Daily values of each variable over the window ending on idx """
+    values = {"Tair": stats.window("Tair", idx, window)}
+    for var in variables:
+        if var in DERIVED:
+            (func, needs) = DERIVED[var]
+            values[var] = func({v: stats.window(v, idx, window)
+                                for v in needs})
+        else:
+            values[var] = stats.window(var, idx, window)
+
+    return values
+
+def get_events(stats, variables, window=4, check_txx=True, tthresh=37.0,
+               rain_threshold=0.2):
+    """
+    Tair and each variable, day by day, for the TXx event followed by every
+    other event above tthresh (deg C), with no more than rain_threshold (mm)
+    of rain over the window. If check_txx, the TXx event is only kept when the
+    TXx itself is above tthresh.
+    """
+    names = ["Tair"] + list(variables)
+
+    # Sort the days once and flag the ones we've used, rather than dropping
+    # them from the daily frames and re-sorting what's left
+    sel = EventSelector(stats, window=window)
+    (TXx, TXx_idx, event_idxs) = find_events(sel, tthresh, rain_threshold)
+
+    #
+    ## Get the TXx event
+    #
+    if TXx_idx is None or (check_txx and TXx < tthresh):
+        events = {v: np.full(window, np.nan) for v in names}
+    else:
+        events = get_values(stats, variables, TXx_idx, window)
+
+    #
+    ## Get all the events other than the TXx that are > Tthresh
+    #
+    for event_idx in event_idxs:
+        values = get_values(stats, variables, event_idx, window)
+        for v in names:
+            x = values[v]
+            events[v] = np.append(events[v], x[~np.isnan(x)])
+
+    for v in names:
+        events[v] = events[v][~np.isnan(events[v])]
+
+    if len(events["Tair"]) < window:
+        events = {v: np.full(window, np.nan) for v in names}
+
+    return events
+
+def event_rows(events):
+    """
+    The events as columns of one length, a row per Tair as the scripts have
+    always written them. Missing days are dropped from each variable on its
+    own (get_events), so e.g. GPP, a daily sum and 0 on a day with no data,
+    can be longer than Tair (cut to it) or Qle shorter (padded with NaN)
+    """
+    n = len(events["Tair"])
+    rows = {}
+    for v, x in events.items():
+        x = x[:n]
+        rows[v] = np.append(x, np.full(n - len(x), np.nan))
+
+    return rows
+
+def sweep_events(stats, variables, windows=[4], tthreshs=[37.0],
+                 rain_thresholds=[0.2], check_txx=True):
+    """
+    Events for every combination of window length, temperature and rain
+    threshold as one table (hot to cool within each combination). The daily
+    stats are shared, each combination gets its own walk through the days so
+    matches a separate run with those settings.
+    """
+    dfs = []
+    for (window, tthresh,
+         rain_threshold) in itertools.product(windows, tthreshs,
+                                              rain_thresholds):
+        events = get_events(stats, variables, window=window,
+                            check_txx=check_txx, tthresh=tthresh,
+                            rain_threshold=rain_threshold)
+
+        dfx = pd.DataFrame(event_rows(events))
+        dfx = dfx.reindex(index=dfx.index[::-1]) # reverse the order hot to cool
+        dfx["window"] = window
+        dfx["Tthresh"] = tthresh
+        dfx["rain_thresh"] = rain_threshold
+        dfs.append(dfx)
+
+    return pd.concat(dfs, ignore_index=True)
+
+def get_hottest_event(stats, variables, window=5, rain_threshold=0.2):
+    """ TXx and the values over the event we settle on for it """
+    sel = EventSelector(stats, window=window)
+    TXx_idx = sel.hottest()
+    TXx = sel.tair[TXx_idx]
+
+    event_idx = is_event_long_enough(sel, TXx_idx, rain_threshold)
+    if event_idx is None:
+        values = {v: np.full(window, np.nan)
+                  for v in ["Tair"] + list(variables)}
+    else:
+        values = get_values(stats, variables, event_idx, window)
+
+    return (TXx, values)
+
+def get_ozflux_pfts():
+
+    sites = ["AdelaideRiver","Calperum","CapeTribulation","CowBay",\
+             "CumberlandPlains","DalyPasture","DalyUncleared",\
+             "DryRiver","Emerald","Gingin","GreatWesternWoodlands",\
+             "HowardSprings","Otway","RedDirtMelonFarm","RiggsCreek",\
+             "Samford","SturtPlains","Tumbarumba","Whroo",\
+             "WombatStateForest","Yanco"]
+
+    pfts = ["SAV","EBF","TRF","TRF","EBF","GRA","SAV",\
+            "SAV","NA","EBF","EBF",\
+            "SAV","GRA","NA","GRA",\
+            "GRA","GRA","EBF","EBF",\
+            "EBF","GRA"]
+
+    d = dict(zip(sites, pfts))
+
+    return d
+
+def mask_crap_days(frames, oz_flux=True, policy=None):
+    """ Bad QA, i.e. any time Qle, Qh and Tair are flagged as being of poor
+    quality, and dew, or whatever the named policy (see qc.py) says. Rather
+    than rewriting every column of every frame we hand back the mask (True
+    where good) to apply to the columns we use. The flux QA goes for every
+    frame, including the model if we have it"""
+    if policy is None:
+        policy = "ozflux" if oz_flux else "fluxnet"
+
+    return qc_mask(frames["qc"], policy)
+
+def open_site(flux_fn, met_fn, cable_fn=None, oz_flux=True, start=None,
+              compact=False, end=None, cache_dir=CACHE_DIR):
+    """
+    Flux, met (and model) frames for a site in analysis units (Tair in deg C,
+    see flux_io.canonicalize), optionally from start on and/or up to end
+    """
+    site = os.path.basename(flux_fn).split("OzFlux")[0]
+
+    if oz_flux == False:
+        (pft, site_name) = read_site_info(flux_fn)
+    else:
+        pft = None
+        site_name = None
+
+    opts = {"start": start, "end": end, "cache_dir": cache_dir,
+            "compact": compact, "canonical": True}
+    frames = {"flx": read_nc(flux_fn, FLUX_VARS, **opts),
+              "met": read_nc(met_fn, MET_VARS, **opts)}
+
+    # Pack the QC flags and drop them from the frames
+    frames["qc"] = pack_qc(frames["flx"], frames["met"])
+    for key in ["flx", "met"]:
+        qc_cols = [col for col in frames[key] if col.endswith("_qc")]
+        frames[key] = frames[key].drop(columns=qc_cols)
+
+    if cable_fn is not None:
+        frames["mod"] = read_nc(cable_fn, MOD_VARS, **opts)
+
+    return (site, frames, pft, site_name)
+
+if __name__ == "__main__":
+
+    oz_flux = True
+    if oz_flux:
+        flux_dir = "/Users/mdekauwe/research/OzFlux"
+        cable_dir = "/Users/mdekauwe/research/CABLE_runs/runs/ozflux/outputs"
+        ofname = "ozflux_all_events_engine.csv"
+    else:
+        flux_dir = "/Users/mdekauwe/Desktop/fluxnet2015_trees"
+        cable_dir = None
+        ofname = "fluxnet2015_all_events_engine.csv"
+    main(flux_dir, ofname, oz_flux=oz_flux, cable_dir=cable_dir)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+"""
+Read the flux, met and CABLE netCDF files into frames.
+
+Rather than turning the whole file into a frame (to_dataframe, which drags
+every variable and coordinate into memory), we ask for the variables we want
+and read each one straight off the file, squeezing out the x/y dims. Nothing
+else in the file is loaded.
+
+Decoded frames are also cached on disk (feather) keyed on the file's path,
+size and modification time and the variables asked for, so a warm run never
+touches the netCDF. Editing or replacing a file changes its key, so stale
+entries are simply never read again; they age out as the cache is held under
+CACHE_SIZE by dropping the least recently used entries. Workers (processes or
+threads) may share the cache, so an entry vanishing under us is just a miss.
+A read of part of a file (start or end given) that misses the cache decodes
+only that part and isn't cached.
+
+With canonical set, read_nc hands back (and caches) the data already in the
+units we analyse in (see canonicalize): Tair in deg C, and Rainf and GPP as
+totals per timestep. The timestep is worked out once per file, from the most
+common spacing of the whole time axis so gaps don't throw it, and kept with
+the frame as df.attrs["timestep"] (seconds).
+
+For records too long to hold whole, get_chunks splits a file's time axis into
+calendar years (or any whole-day frequency) so it can be read a chunk at a
+time with read_nc(..., start, end).
+
+get_manifest describes every site in a directory (site, PFT, its flux, met and
+CABLE files, time span, timestep and which variables it has) from the file
+headers and time axes alone, so scripts can pick the sites they want without
+reading any data. Flux and met files are paired on their shared file name
+prefix rather than by sort order.
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import os
+import sys
+import glob
+import json
+import queue
+import hashlib
+import threading
+import numpy as np
+import xarray as xr
+import pandas as pd
+
+import constants as c
+import daily_store
+
+# What the heatwave extraction needs out of each file
+FLUX_VARS = ["Qle", "Qh", "GPP", "Qle_qc", "Qh_qc", "GPP_qc"]
+MET_VARS = ["Tair", "Rainf", "Tair_qc"]
+MOD_VARS = ["Qle", "Qh", "GPP"]
+
+CACHE_DIR = "cache"
+CACHE_SIZE = 2 * 1024**3 # bytes
+
+def read_nc(fname, variables, start=None, cache_dir=CACHE_DIR, compact=False,
+            canonical=False, end=None):
+    """
+    Frame of just the requested variables, indexed by time. Variables the file
+    doesn't have are left out. If start (end) is given, only data from (up
+    to, but not including) then are returned. Set cache_dir to None to bypass
+    the cache, compact to get the frame back as float32 and int8 (see
+    compact_frame) and canonical to get it in analysis units (see
+    canonicalize).
+    """
+    if cache_dir is None:
+        df = decode_nc(fname, variables, start=start, end=end)
+        if canonical:
+            df = canonicalize(df)
+        return compact_frame(df) if compact else df
+
+    key = cache_key(fname, variables, canonical)
+    cache_fn = os.path.join(cache_dir, "%s.feather" % (key))
+    df = read_cache(cache_fn)
+    if df is None:
+        if start is not None or end is not None:
+            # Just decode the part asked for (e.g. the tail of a file that has
+            # been appended to) rather than the whole file to cache it
+            return read_nc(fname, variables, start=start, cache_dir=None,
+                           compact=compact, canonical=canonical, end=end)
+        df = decode_nc(fname, variables)
+        if canonical:
+            df = canonicalize(df)
+        write_cache(df, cache_fn, cache_dir)
+
+    if start is not None:
+        df = df[df.index >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df.index < pd.Timestamp(end)]
+
+    return compact_frame(df) if compact else df
+
+def canonicalize(df):
+    """
+    Frame in analysis units: Tair K -> deg C, Rainf kg m-2 s-1 -> mm per
+    timestep and GPP umol m-2 s-1 -> g C m-2 per timestep. The timestep comes
+    from df.attrs, as set by decode_nc.
+    """
+    timestep = df.attrs["timestep"]
+
+    df = df.copy()
+    if "Tair" in df:
+        df["Tair"] -= c.DEG_2_KELVIN
+    if "Rainf" in df:
+        df["Rainf"] *= timestep
+    if "GPP" in df:
+        df["GPP"] *= 12. * 0.000001 * timestep
+
+    return df
+
+def get_timestep(time):
+    """
+    Seconds between samples, hourly (i.e. Tumba) or half-hourly. We take the
+    most common spacing, so gaps in the record don't matter
+    """
+    steps = np.diff(time.values.astype("datetime64[s]")).astype(np.int64)
+    steps = steps[steps > 0]
+    if len(steps) == 0:
+        raise ValueError("Can't get a timestep from fewer than two times")
+    (values, counts) = np.unique(steps, return_counts=True)
+
+    return float(values[np.argmax(counts)])
+
+def compact_frame(df):
+    """
+    Roughly half the memory: float32 data and int8 QC flags. A missing flag
+    becomes -1, which, like the NaN it replaces, never passes a QC test.
+    """
+    qc = [col for col in df.columns if col.endswith("_qc")]
+    dtypes = {col: np.float32 for col in df.columns
+              if col not in qc and df[col].dtype == np.float64}
+    dtypes.update({col: np.int8 for col in qc})
+
+    return df.fillna({col: -1 for col in qc}).astype(dtypes)
+
+def cache_key(fname, variables, canonical=False):
+    """
+    Hash of the file's path, size, mtime, the variables asked for and whether
+    they are in analysis units
+    """
+    key = [os.path.abspath(fname), os.path.getsize(fname),
+           os.path.getmtime(fname), list(variables), canonical]
+
+    return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+def read_cache(cache_fn):
+    """
+    The cached frame, None if we haven't got one. Other workers share the
+    cache, so an entry can be evicted from under us at any point, which is
+    also a miss
+    """
+    try:
+        df = pd.read_feather(cache_fn).set_index("time")
+        os.utime(cache_fn) # mark as recently used
+    except FileNotFoundError:
+        return None
+
+    if "timestep" not in df.attrs:
+        df.attrs["timestep"] = get_timestep(df.index)
+
+    return df
+
+def write_cache(df, cache_fn, cache_dir):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Write then rename, so another run never sees half a file
+    tmp_fn = "%s.%d.tmp" % (cache_fn, os.getpid())
+    df.reset_index().to_feather(tmp_fn)
+    os.replace(tmp_fn, cache_fn)
+
+    evict(cache_dir, CACHE_SIZE)
+
+def evict(cache_dir, max_size, pattern="*.feather"):
+    """
+    Drop the least recently used entries until we fit under max_size. Files
+    another worker removes while we're at it are skipped
+    """
+    entries = []
+    for fn in glob.glob(os.path.join(cache_dir, pattern)):
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, fn))
+    entries.sort()
+
+    total = sum(size for (mtime, size, fn) in entries)
+    for (mtime, size, fn) in entries[:-1]:
+        if total <= max_size:
+            break
+        try:
+            os.remove(fn)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def decode_nc(fname, variables, start=None, end=None):
+    """
+    Read the requested variables off the netCDF file, only those between
+    start and end (exclusive) if given. The timestep of the whole file goes
+    in df.attrs["timestep"]
+    """
+    ds = xr.open_dataset(fname)
+    time = pd.to_datetime(ds.time.values)
+    timestep = get_timestep(time)
+
+    i = 0 if start is None else time.searchsorted(pd.Timestamp(start))
+    j = len(time) if end is None else time.searchsorted(pd.Timestamp(end))
+    tslice = slice(i, j)
+    time = time[tslice]
+
+    data = {}
+    for var in variables:
+        if var in ds.variables:
+            x = ds[var].isel(time=tslice).values
+            data[var] = x.reshape(len(time))
+    ds.close()
+
+    df = pd.DataFrame(data, index=pd.Index(time, name="time"))
+    df.attrs["timestep"] = timestep
+
+    return df
+
+def get_chunks(fname, freq="YS", start=None):
+    """
+    (start, end) of each chunk of the file's time axis, calendar years by
+    default. freq is any pandas frequency of whole days (e.g. "90D"), so no
+    day is split between chunks. Chunks without data (i.e. a missing year)
+    are left out and the last chunk's end is None
+    """
+    ds = xr.open_dataset(fname)
+    time = pd.to_datetime(ds.time.values)
+    ds.close()
+
+    if start is not None:
+        time = time[time >= pd.Timestamp(start)]
+    if len(time) == 0:
+        return []
+
+    edges = pd.date_range(time[0].normalize(), time[-1], freq=freq)
+    edges = [edge for edge in edges if edge > time[0]]
+
+    starts = [time[0]] + edges
+    counts = np.diff(np.append(time.searchsorted(starts), len(time)))
+
+    return [(lo, hi) for (lo, hi, n) in zip(starts, edges + [None], counts)
+            if n > 0]
+
+def read_site_info(flux_fn):
+    """ PFT and site name from a FLUXNET2015 flux file's header """
+    ds = xr.open_dataset(flux_fn)
+    pft = (str(ds.IGBP_veg_short.values, 'utf-8'))
+    pft = pft.replace(" ", "")
+
+    site_name = ds.site_name
+    site_name = site_name.replace(" ", "")
+    ds.close()
+
+    return (pft, site_name)
+
+def prefetch(func, args, nahead=2):
+    """
+    Yields func(*a) for each a in args, in order. The calls are made on a
+    background thread, up to nahead results ahead of the caller.
+    """
+    q = queue.Queue(maxsize=nahead)
+
+    def worker():
+        for a in args:
+            try:
+                q.put((func(*a), None))
+            except Exception as err:
+                q.put((None, err))
+                return
+        q.put(None)
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True # don't hang about if the caller stops early
+    thread.start()
+
+    while True:
+        item = q.get()
+        if item is None:
+            break
+
+        (result, err) = item
+        if err is not None:
+            raise err
+        yield result
+
+def get_manifest(flux_dir, oz_flux=True, cable_dir=None, pfts=None,
+                 cache_dir=CACHE_DIR):
+    """
+    One row per site: site, pft, flux_fn, met_fn, cable_fn, start, end,
+    timestep (seconds) and variables (space separated, flux and met). OzFlux
+    files don't carry a PFT, so pass a dict of site: pft. The manifest is
+    kept in cache_dir and only the rows whose files changed are rebuilt.
+    """
+    if oz_flux:
+        flux_files = sorted(glob.glob(os.path.join(flux_dir, "*_flux.nc")))
+        met_suffix = ("_flux.nc", "_met.nc")
+    else:
+        flux_files = sorted(glob.glob(os.path.join(flux_dir, "*_Flux.nc")))
+        met_suffix = ("_Flux.nc", "_Met.nc")
+
+    if cable_dir is not None:
+        # The CABLE output doesn't share the flux file names, these still go
+        # by sort order
+        cable_files = sorted(glob.glob(os.path.join(cable_dir, "*_out.nc")))
+    else:
+        cable_files = [None] * len(flux_files)
+
+    old = {}
+    manifest_fn = None
+    if cache_dir is not None:
+        key = json.dumps([os.path.abspath(flux_dir), oz_flux, cable_dir])
+        key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        manifest_fn = os.path.join(cache_dir, "manifest_%s.csv" % (key))
+        if os.path.exists(manifest_fn):
+            df = pd.read_csv(manifest_fn, keep_default_na=False,
+                             na_values=[""])
+            old = {row["flux_fn"]: row for row in df.to_dict("records")}
+
+    rows = []
+    for flux_fn, cable_fn in zip(flux_files, cable_files):
+        met_fn = flux_fn.replace(*met_suffix)
+        if not os.path.exists(met_fn):
+            print("No met file for %s, skipping" % (flux_fn))
+            continue
+
+        fp = json.dumps(daily_store.fingerprint([flux_fn, met_fn, cable_fn]))
+        if flux_fn in old and old[flux_fn]["fingerprint"] == fp:
+            row = old[flux_fn]
+        else:
+            row = get_header_info(flux_fn, met_fn, oz_flux=oz_flux)
+        row.update({"flux_fn": flux_fn, "met_fn": met_fn,
+                    "cable_fn": cable_fn, "fingerprint": fp})
+        if pfts is not None:
+            row["pft"] = pfts.get(row["site"])
+        rows.append(row)
+
+    cols = ["site", "pft", "flux_fn", "met_fn", "cable_fn", "start", "end",
+            "timestep", "variables", "fingerprint"]
+    df = pd.DataFrame(rows, columns=cols)
+    df["start"] = pd.to_datetime(df["start"])
+    df["end"] = pd.to_datetime(df["end"])
+
+    if manifest_fn is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        df.to_csv(manifest_fn, index=False)
+
+    return df
+
+def get_header_info(flux_fn, met_fn, oz_flux=True):
+    """ What we can learn about a site without reading its data """
+    if oz_flux:
+        site = os.path.basename(flux_fn).split("OzFlux")[0]
+        pft = None
+    else:
+        (pft, site) = read_site_info(flux_fn)
+
+    # Opening is lazy, the only thing read is the time axis
+    variables = []
+    for fname in (flux_fn, met_fn):
+        ds = xr.open_dataset(fname)
+        variables += [v for v in ds.data_vars if v not in variables]
+        time = pd.to_datetime(ds.time.values)
+        ds.close()
+
+    return {"site": site, "pft": pft, "start": time[0], "end": time[-1],
+            "timestep": get_timestep(time),
+            "variables": " ".join(variables)}
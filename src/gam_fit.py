@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+
+"""
+The GAM fits behind the functional relationship plots (split_data.py and
+generate_functional_reln*.py).
+
+Fitted models are kept on disk (pickled), keyed on a hash of the x and y
+data and the model settings (and the pygam version), so re-drawing a figure
+with the same data doesn't refit anything. Change the data or the settings
+and the key changes with them; old entries age out as the cache is held
+under GAM_CACHE_SIZE by dropping the least recently used.
+
+fit_gams does a batch of fits (e.g. every group, predictor and response for
+a figure) at once, farming each point of each lambda grid out to a pool of
+processes and keeping, as gridsearch does, the lowest GCV fit of each.
+
+For pooled data (millions of points) a job can instead be fitted on bins of
+x: the mean x and y of each bin, weighted by its count. For a Gaussian GAM
+that is the same least squares problem bar the spread of x within a bin, so
+with fine bins (0.1 deg C, 1 W m-2) the curves are the same and fit time goes
+with the number of bins. The within bin variance of y is kept too, so GCV
+(and with it the choice of lambda), the scale and hence the intervals are
+those of the raw data.
+
+Jobs on the same x, e.g. Qle and Qh against SWdown, share a spline basis and
+penalty, so for each lambda they are solved together off one decomposition
+(fit_shared), and predict_grid draws the curves and intervals of such a set
+on one grid, with its basis built once.
+
+Neighbouring sites and PFTs end up with much the same smoothing, so rather
+than fit the whole lambda grid every time fit_gams can search for lambda
+(search="adaptive"), starting from the one last picked for the same job
+(e.g. SWdown vs Qle), kept in the cache directory.
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import os
+import sys
+import json
+import pickle
+import hashlib
+import numpy as np
+import pygam
+from copy import deepcopy
+from pygam import LinearGAM
+from concurrent.futures import ProcessPoolExecutor
+
+from flux_io import evict
+
+# fit_shared and predict_grid work on pygam's internals (its model matrix,
+# penalty, PIRLS statistics and intervals) as they are in this version
+PYGAM_VERSION = "0.12"
+if pygam.__version__.split(".")[:2] != PYGAM_VERSION.split("."):
+    raise ImportError("gam_fit needs pygam %s.x, not %s" %
+                      (PYGAM_VERSION, pygam.__version__))
+
+GAM_CACHE_DIR = "gam_cache"
+GAM_CACHE_SIZE = 512 * 1024**2 # bytes
+
+# gridsearch's default lambda grid, and the gamma it uses in GCV
+LAMS = np.logspace(-3, 3, 11)
+GAMMA = 1.4
+
+# Adaptive search, in log10 lambda: over the range of the grid, starting
+# either side of the last lambda picked, stopping within LOG_LAM_TOL
+LOG_LAM_MIN = -3.
+LOG_LAM_MAX = 3.
+STEP = 0.5
+LOG_LAM_TOL = 0.1
+MAX_FITS = 8
+LAM_HISTORY_FN = "lam_history.json"
+
+def fit_gams(jobs, n_splines=20, nworkers=1, cache_dir=GAM_CACHE_DIR,
+             search="grid"):
+    """
+    LinearGAM(n_splines=n_splines).gridsearch(x, y) for a dict of name:
+    (x, y), e.g. keyed on (group, predictor, response), with the fits spread
+    over nworkers processes and taken from the cache if we've fitted those
+    data before (set cache_dir to None to always fit). Returns a dict of
+    name: GAM, each the lowest GCV fit of its lambda grid, i.e. the model
+    gridsearch picks. A job given as (x, y, width) is fitted on bins of x
+    that wide (see bin_xy).
+
+    With search="adaptive" each job starts from the lambda last picked for
+    that name (kept in cache_dir, see search_lams) and homes in on the GCV
+    minimum from there, which takes 3-4 fits rather than the 11 of the grid
+    """
+    gams = {}
+    todo = []
+    for name, job in jobs.items():
+        (x, y, width) = split_job(job)
+        if cache_dir is not None:
+            cache_fn = get_cache_fn(cache_dir, x, y, n_splines, width, search)
+            gams[name] = load_gam(cache_fn)
+        if gams.get(name) is None:
+            todo.append(name)
+
+    # What actually gets fitted: the data, or the bin means and counts
+    bins = {}
+    data = {}
+    for name in todo:
+        (x, y, width) = split_job(jobs[name])
+        if width is None:
+            data[name] = (x, y, None)
+        else:
+            bins[name] = bin_xy(x, y, width)
+            data[name] = bins[name][:3]
+
+    # Jobs fitted on the same x (and weights) are solved together
+    groups = {}
+    for name in todo:
+        (x, y, weights) = data[name]
+        key = gam_key(x, () if weights is None else weights, {})
+        groups.setdefault(key, []).append(name)
+    groups = list(groups.values())
+
+    pool = None
+    if nworkers > 1 and todo:
+        pool = ProcessPoolExecutor(max_workers=nworkers)
+    try:
+        if search == "adaptive":
+            tried = search_lams(groups, data, bins, n_splines, pool,
+                                cache_dir)
+        else:
+            tasks = [(names, lam) for names in groups for lam in LAMS]
+            tried = run_tasks(tasks, data, bins, n_splines, pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    for name in todo:
+        gams[name] = best_fit(tried[name])[1]
+        if gams[name] is None:
+            continue
+        if name in bins:
+            unbin_stats(gams[name], bins[name])
+        if cache_dir is not None:
+            (x, y, width) = split_job(jobs[name])
+            save_gam(gams[name], get_cache_fn(cache_dir, x, y, n_splines,
+                                              width, search), cache_dir)
+
+    return gams
+
+def run_tasks(tasks, data, bins, n_splines, pool=None, tried=None):
+    """
+    fit_lam for each (names, lam), in the pool if we have one. Returns (or
+    adds to) a dict of name: {lam: (GCV, GAM)}, inf and None for a fit that
+    failed
+    """
+    args = ([data[names[0]][0] for (names, lam) in tasks],
+            [[data[name][1] for name in names] for (names, lam) in tasks],
+            [n_splines] * len(tasks), [lam for (names, lam) in tasks],
+            [data[names[0]][2] for (names, lam) in tasks])
+    if pool is None:
+        fits = list(map(fit_lam, *args))
+    else:
+        fits = list(pool.map(fit_lam, *args))
+
+    if tried is None:
+        tried = {name: {} for (names, lam) in tasks for name in names}
+    for (names, lam), group_fits in zip(tasks, fits):
+        for name, gam in zip(names, group_fits):
+            if gam is None:
+                score = np.inf
+            elif name in bins:
+                score = binned_gcv(gam, bins[name])
+            else:
+                score = gam.statistics_["GCV"]
+            tried[name][lam] = (score, gam)
+
+    return tried
+
+def best_fit(tried):
+    """ (lam, GAM) with the lowest GCV, ties going to the smaller lambda """
+    best = (None, None)
+    score = np.inf
+    for lam in sorted(tried):
+        if tried[lam][0] < score:
+            (score, best) = (tried[lam][0], (lam, tried[lam][1]))
+
+    return best
+
+def search_lams(groups, data, bins, n_splines, pool=None,
+                cache_dir=GAM_CACHE_DIR):
+    """
+    Adaptive search for lambda, for each job of each group. Each starts from
+    the lambda last picked for that name (or failing that the middle of
+    those picked for any name, or of the grid), fits either side of it and
+    then steps, in log lambda, outwards until the GCV minimum is bracketed
+    and in to the minimum of a parabola through the bracket. The rounds of
+    every job go to the pool together, and a group is fitted at the lambdas
+    any of its jobs asks for, so each job gets the others' points for free.
+    The lambdas picked are written back to the history in cache_dir
+    """
+    history = load_history(cache_dir)
+    default = np.median(list(history.values())) if history else 0.0
+
+    tried = {name: {} for names in groups for name in names}
+    want = {}
+    for name in tried:
+        start = history.get(history_key(name), default)
+        want[name] = [10.**l for l in
+                      np.clip([start - STEP, start, start + STEP],
+                              LOG_LAM_MIN, LOG_LAM_MAX)]
+
+    while any(want.values()):
+        tasks = []
+        for names in groups:
+            lams = set()
+            for name in names:
+                lams.update(lam for lam in want[name]
+                            if lam not in tried[name])
+            tasks += [(names, lam) for lam in sorted(lams)]
+        run_tasks(tasks, data, bins, n_splines, pool, tried)
+        want = {name: next_lams(tried[name]) for name in tried}
+
+    for name in tried:
+        lam = best_fit(tried[name])[0]
+        if lam is not None:
+            history[history_key(name)] = float(np.log10(lam))
+    save_history(history, cache_dir)
+
+    return tried
+
+def next_lams(tried):
+    """
+    The next lambda to try given the GCV at those tried so far, as a list
+    (empty once we're done)
+    """
+    if len(tried) >= MAX_FITS:
+        return []
+
+    lams = sorted(tried)
+    l = np.log10(lams)
+    f = np.array([tried[lam][0] for lam in lams])
+    i = int(np.argmin(f))
+    if not np.isfinite(f[i]):
+        return []
+
+    # Minimum at an end of what we've tried, so step outwards, doubling
+    if i == 0:
+        if l[0] <= LOG_LAM_MIN:
+            return []
+        step = max(STEP, 2. * (l[1] - l[0])) if len(l) > 1 else STEP
+        return [10.**max(l[0] - step, LOG_LAM_MIN)]
+    if i == len(l) - 1:
+        if l[-1] >= LOG_LAM_MAX:
+            return []
+        step = max(STEP, 2. * (l[-1] - l[-2]))
+        return [10.**min(l[-1] + step, LOG_LAM_MAX)]
+
+    # Bracketed, so go to the minimum of the parabola through the bracket
+    (a, b, c) = l[i-1:i+2]
+    (fa, fb, fc) = f[i-1:i+2]
+    if not (np.isfinite(fa) and np.isfinite(fc)) or c - a <= 2. * LOG_LAM_TOL:
+        return []
+    den = (b - a) * (fb - fc) - (b - c) * (fb - fa)
+    if den == 0:
+        return []
+    v = b - 0.5 * ((b - a)**2 * (fb - fc) - (b - c)**2 * (fb - fa)) / den
+    v = np.clip(v, a, c)
+    if np.min(np.abs(l - v)) < LOG_LAM_TOL:
+        return []
+
+    return [10.**v]
+
+def history_key(name):
+    if isinstance(name, tuple):
+        return "/".join(str(n) for n in name)
+    return str(name)
+
+def load_history(cache_dir):
+    """ Lambda (log10) last picked for each job name, {} if we've none """
+    if cache_dir is None:
+        return {}
+    history_fn = os.path.join(cache_dir, LAM_HISTORY_FN)
+    if not os.path.exists(history_fn):
+        return {}
+
+    with open(history_fn, "r") as f:
+        return json.load(f)
+
+def save_history(history, cache_dir):
+    if cache_dir is None:
+        return
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Write then rename, as save_gam
+    history_fn = os.path.join(cache_dir, LAM_HISTORY_FN)
+    tmp_fn = "%s.%d.tmp" % (history_fn, os.getpid())
+    with open(tmp_fn, "w") as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+    os.replace(tmp_fn, history_fn)
+
+def split_job(job):
+    """ (x, y, width) of a job, width None if we fit the data as they are """
+    return (job[0], job[1], job[2] if len(job) > 2 else None)
+
+def fit_lam(x, ys, n_splines, lam, weights=None):
+    """ One point of the lambda grid for each of ys, None for any that won't
+    fit (gridsearch skips those too) """
+    try:
+        if len(ys) == 1:
+            return [LinearGAM(n_splines=n_splines,
+                              lam=lam).fit(x, ys[0], weights)]
+        return fit_shared(x, ys, n_splines, lam, weights)
+    except ValueError:
+        return [None] * len(ys)
+
+def fit_shared(x, ys, n_splines, lam, weights=None):
+    """
+    LinearGAM(n_splines=n_splines, lam=lam).fit(x, y, weights) for each of
+    ys, with the basis, penalty and the QR/SVD of the penalised system done
+    once for all of them. This is pygam's PIRLS, which for a Gaussian GAM
+    is the solution after one step, as the weights don't depend on the fit
+    """
+    X = np.asarray(x, dtype=np.float64)
+    X = X.reshape(len(X), -1)
+    Y = np.column_stack([np.asarray(y, dtype=np.float64).ravel()
+                         for y in ys])
+    if weights is None:
+        weights = np.ones(len(X))
+    weights = np.asarray(weights, dtype=np.float64).ravel()
+    if not (np.isfinite(X).all() and np.isfinite(Y).all()):
+        raise ValueError("x and y must be finite")
+
+    base = LinearGAM(n_splines=n_splines, lam=lam)
+    base._validate_params()
+    base._validate_data_dep_params(X)
+    base.statistics_ = {"n_samples": len(X), "m_features": X.shape[1]}
+
+    modelmat = base._modelmat(X)
+    (n, m) = modelmat.shape
+    S = np.eye(m) * np.sqrt(np.finfo(np.float64).eps) # as pygam, conditioning
+    E = base._cholesky(S + base._P(), sparse=False, verbose=False)
+
+    sqrt_w = np.sqrt(weights)
+    WB = modelmat.multiply(sqrt_w[:, None]).tocsc()
+    (Q, R) = np.linalg.qr(WB.toarray())
+    (U, d, Vt) = np.linalg.svd(np.vstack([R, E]), full_matrices=False)
+    keep = min(m, n)
+    U1 = U[:keep, :keep]
+    B = (Vt[:keep].T * d[:keep]**-1).dot(U1.T).dot(Q.T)
+
+    coefs = B.dot(sqrt_w[:, None] * Y)
+    gams = []
+    for i in range(Y.shape[1]):
+        gam = deepcopy(base)
+        gam.coef_ = coefs[:, i]
+        gam._estimate_model_statistics(Y[:, i], modelmat, BW=WB.T, B=B,
+                                       weights=weights, U1=U1)
+        gams.append(gam)
+
+    return gams
+
+def predict_grid(gams, width=.95, prediction=False):
+    """
+    generate_X_grid (500 points, as the old pygam.utils one), predict and
+    confidence_intervals (prediction_intervals if prediction) for each of a
+    set of GAMs, as (grid, prediction, intervals). GAMs fitted on the same x
+    share the grid, and its basis is built once
+    """
+    grids = {}
+    curves = []
+    for gam in gams:
+        key = (len(gam.coef_), np.asarray(gam.edge_knots_).tobytes())
+        if key not in grids:
+            XX = gam.generate_X_grid(0, n=500)
+            grids[key] = (XX, gam._modelmat(XX))
+        (XX, modelmat) = grids[key]
+
+        lp = gam._linear_predictor(modelmat=modelmat)
+        intervals = gam._get_quantiles(XX, width, None, modelmat=modelmat,
+                                       lp=lp, prediction=prediction)
+        curves.append((XX, gam.link.mu(lp, gam.distribution), intervals))
+
+    return curves
+
+def bin_xy(x, y, width):
+    """
+    Bins of x, width wide: the mean x and y of each bin, how many points are
+    in it and the sum of squares of y about its mean. Missing data are
+    dropped
+    """
+    x = np.asarray(x, dtype=np.float64).ravel()
+    y = np.asarray(y, dtype=np.float64).ravel()
+    ok = ~(np.isnan(x) | np.isnan(y))
+    (x, y) = (x[ok], y[ok])
+
+    (ids, inv, n) = np.unique(np.floor(x / width), return_inverse=True,
+                              return_counts=True)
+    x_mean = np.bincount(inv, weights=x) / n
+    y_mean = np.bincount(inv, weights=y) / n
+    ss = np.bincount(inv, weights=(y - y_mean[inv])**2)
+
+    return (x_mean, y_mean, n, ss)
+
+def raw_rss(gam, binned):
+    """ Residual sum of squares the fit would have on the unbinned data """
+    (x_mean, y_mean, n, ss) = binned
+
+    return np.sum(ss) + np.sum(n * (y_mean - gam.predict(x_mean))**2)
+
+def binned_gcv(gam, binned):
+    """ GCV, as pygam has it, of the fit on the unbinned data """
+    nobs = np.sum(binned[2])
+    edof = gam.statistics_["edof"]
+
+    return nobs * raw_rss(gam, binned) / (nobs - GAMMA * edof)**2
+
+def unbin_stats(gam, binned):
+    """
+    Put the statistics of a fit to bins on the footing of the unbinned data,
+    i.e. the scale and parameter covariance the intervals come from
+    """
+    (x_mean, y_mean, n, ss) = binned
+    nobs = np.sum(n)
+    edof = gam.statistics_["edof"]
+
+    phi_bins = (np.sum(n * (y_mean - gam.predict(x_mean))**2) /
+                (len(n) - edof))
+    phi = raw_rss(gam, binned) / (nobs - edof)
+    ratio = phi / phi_bins
+
+    gam.statistics_["cov"] = gam.statistics_["cov"] * ratio
+    gam.statistics_["se"] = gam.statistics_["se"] * np.sqrt(ratio)
+
+    # pygam (PYGAM_VERSION) keeps the square root of phi as the scale
+    gam.distribution.scale = np.sqrt(phi)
+    gam.statistics_["scale"] = gam.distribution.scale
+
+    gam.statistics_["GCV"] = binned_gcv(gam, binned)
+    gam.statistics_["n_samples"] = nobs
+
+def get_cache_fn(cache_dir, x, y, n_splines, width=None, search="grid"):
+    settings = {"model": "LinearGAM", "n_splines": n_splines,
+                "search": "gridsearch" if search == "grid" else search,
+                "pygam": pygam.__version__}
+    if width is not None:
+        settings["bin_width"] = width
+
+    return os.path.join(cache_dir, "%s.pkl" % (gam_key(x, y, settings)))
+
+def load_gam(cache_fn):
+    """ The cached fit, None if we haven't got one """
+    if not os.path.exists(cache_fn):
+        return None
+
+    with open(cache_fn, "rb") as f:
+        gam = pickle.load(f)
+    os.utime(cache_fn) # mark as recently used
+
+    return gam
+
+def save_gam(gam, cache_fn, cache_dir):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Write then rename, so another run never sees half a file
+    tmp_fn = "%s.%d.tmp" % (cache_fn, os.getpid())
+    with open(tmp_fn, "wb") as f:
+        pickle.dump(gam, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fn, cache_fn)
+
+    evict(cache_dir, GAM_CACHE_SIZE, pattern="*.pkl")
+
+def gam_key(x, y, settings):
+    """ Hash of the data (values and shape) and the model settings """
+    h = hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    for data in (x, y):
+        data = np.ascontiguousarray(data, dtype=np.float64)
+        h.update(str(data.shape).encode("utf-8"))
+        h.update(data.tobytes())
+
+    return h.hexdigest()
@@ -26,10 +26,15 @@ import xarray as xr
 import matplotlib.pyplot as plt
 import pandas as pd
 import itertools
-from pygam import LinearGAM
-from pygam.utils import generate_X_grid
 
-def main(flux_dir):
+from qc import pack_qc, qc_mask
+from gam_fit import fit_gams, predict_grid
+
+# Bins the pooled data are fitted on, W m-2 and deg C
+SW_BIN = 1.0
+TAIR_BIN = 0.1
+
+def main(flux_dir, nworkers=1, binned=False, search="grid"):
     K_TO_C = 273.15
     sites = ["AdelaideRiver","Calperum","CapeTribulation","CowBay",\
              "CumberlandPlains","DalyPasture","DalyUncleared",\
@@ -68,21 +73,10 @@ def main(flux_dir):
             pft = d[site]
             colour_id = id[site]
 
-            # Mask crap stuff
-            df_met.where(df_flx.Qle_qc == 1, inplace=True)
-            df_met.where(df_flx.Qh_qc == 1, inplace=True)
-
-            df_flx.where(df_flx.Qle_qc == 1, inplace=True)
-            df_flx.where(df_flx.Qh_qc == 1, inplace=True)
-            #df_flx.where(df_met.Tair_qc == 1, inplace=True)
-            #df_flx.where(df_met.SWdown == 1, inplace=True)
-
-            #df_met.where(df_met.SWdown == 1, inplace=True)
-            #df_met.where(df_met.Tair_qc == 1, inplace=True)
-
-            # Mask dew
-            df_met.where(df_flx.Qle > 0., inplace=True)
-            df_flx.where(df_flx.Qle > 0., inplace=True)
+            # Mask crap stuff and dew, see qc.POLICIES
+            good = qc_mask(pack_qc(df_flx, df_met), "ozflux_fluxes")
+            df_flx = df_flx.where(good)
+            df_met = df_met.where(good)
 
             df_flx.dropna(inplace=True)
             df_met.dropna(inplace=True)
@@ -149,7 +143,8 @@ def main(flux_dir):
     ax3 = fig.add_subplot(223)
     ax4 = fig.add_subplot(224)
 
-    colour_id = 0
+    # Fit every PFT, predictor and response in one go, spread over nworkers
+    jobs = {}
     for pft in np.unique(pfts):
 
         if pft != "NA":
@@ -160,35 +155,29 @@ def main(flux_dir):
 
             print(pft, len(qle), len(qh), len(tair), len(sw))
 
-            gam = LinearGAM(n_splines=20).gridsearch(sw, qh)
-            XX = generate_X_grid(gam)
-            CI = gam.confidence_intervals(XX, width=.95)
+            # Millions of points per PFT, with binned fit on bins of the
+            # predictor instead (see gam_fit)
+            sw_bin = (SW_BIN,) if binned else ()
+            tair_bin = (TAIR_BIN,) if binned else ()
+            jobs[(pft, "SWdown", "Qh")] = (sw, qh) + sw_bin
+            jobs[(pft, "SWdown", "Qle")] = (sw, qle) + sw_bin
+            jobs[(pft, "Tair", "Qh")] = (tair, qh) + tair_bin
+            jobs[(pft, "Tair", "Qle")] = (tair, qle) + tair_bin
+    gams = fit_gams(jobs, nworkers=nworkers, search=search)
 
-            ax1.plot(XX, gam.predict(XX), color=colours[colour_id], ls='-', lw=2.0)
-            ax1.fill_between(XX[:,0], CI[:,0], CI[:,1], color=colours[colour_id],
-                             alpha=0.7)
-
-            gam = LinearGAM(n_splines=20).gridsearch(sw, qle)
-            XX = generate_X_grid(gam)
-            CI = gam.confidence_intervals(XX, width=.95)
-
-            ax2.plot(XX, gam.predict(XX), color=colours[colour_id], ls='-', lw=2.0)
-            ax2.fill_between(XX[:,0], CI[:,0], CI[:,1], color=colours[colour_id],
-                             alpha=0.7)
-
-            gam = LinearGAM(n_splines=20).gridsearch(tair, qh)
-            XX = generate_X_grid(gam)
-            CI = gam.confidence_intervals(XX, width=.95)
-            ax3.plot(XX, gam.predict(XX), color=colours[colour_id], ls='-', lw=2.0)
-            ax3.fill_between(XX[:,0], CI[:,0], CI[:,1], color=colours[colour_id],
-                             alpha=0.7)
+    colour_id = 0
+    for pft in np.unique(pfts):
 
-            gam = LinearGAM(n_splines=20).gridsearch(tair, qle)
-            XX = generate_X_grid(gam)
-            CI = gam.confidence_intervals(XX, width=.95)
-            ax4.plot(XX, gam.predict(XX), color=colours[colour_id], ls='-', lw=2.0)
-            ax4.fill_between(XX[:,0], CI[:,0], CI[:,1], color=colours[colour_id],
-                             alpha=0.7)
+        if pft != "NA":
+            # Qh and Qle on one grid of each predictor
+            curves = (predict_grid([gams[(pft, "SWdown", "Qh")],
+                                    gams[(pft, "SWdown", "Qle")]]) +
+                      predict_grid([gams[(pft, "Tair", "Qh")],
+                                    gams[(pft, "Tair", "Qle")]]))
+            for ax, (XX, pred, CI) in zip([ax1, ax2, ax3, ax4], curves):
+                ax.plot(XX, pred, color=colours[colour_id], ls='-', lw=2.0)
+                ax.fill_between(XX[:,0], CI[:,0], CI[:,1],
+                                color=colours[colour_id], alpha=0.7)
 
             colour_id += 1
 
@@ -234,4 +223,4 @@ def open_file(flux_fn, met_fn):
 if __name__ == "__main__":
 
     flux_dir = "/Users/mdekauwe/research/OzFlux"
-    main(flux_dir)
+    main(flux_dir, nworkers=os.cpu_count())
@@ -26,10 +26,11 @@ import xarray as xr
 import matplotlib.pyplot as plt
 import pandas as pd
 
-from pygam import LinearGAM
-from pygam.utils import generate_X_grid
 
-def main(flux_dir):
+from qc import pack_qc, qc_mask
+from gam_fit import fit_gams, predict_grid
+
+def main(flux_dir, nworkers=1, search="grid"):
 
     sites = ["AdelaideRiver","Calperum","CapeTribulation","CowBay",\
              "CumberlandPlains","DalyPasture","DalyUncleared",\
@@ -59,7 +60,8 @@ def main(flux_dir):
         print(site)
 
         #if site != "CowBay" and site != "Tumbarumba":
-        make_plot(plot_dir, site, df_flx, df_met)
+        make_plot(plot_dir, site, df_flx, df_met, nworkers=nworkers,
+                  search=search)
 
         sys.exit()
 
@@ -79,7 +81,8 @@ def open_file(flux_fn, met_fn):
 
     return (site, df_flx, df_met)
 
-def make_plot(plot_dir, site, df_flx, df_met):
+def make_plot(plot_dir, site, df_flx, df_met, nworkers=1,
+              search="grid"):
 
     K_TO_C = 273.15
 
@@ -115,21 +118,10 @@ def make_plot(plot_dir, site, df_flx, df_met):
     ax1 = fig.add_subplot(121)
     ax2 = fig.add_subplot(122)
 
-    # Mask crap stuff
-    df_met.where(df_flx.Qle_qc == 1, inplace=True)
-    df_met.where(df_flx.Qh_qc == 1, inplace=True)
-
-    df_flx.where(df_flx.Qle_qc == 1, inplace=True)
-    df_flx.where(df_flx.Qh_qc == 1, inplace=True)
-    #df_flx.where(df_met.Tair_qc == 1, inplace=True)
-    #df_flx.where(df_met.SWdown == 1, inplace=True)
-
-    #df_met.where(df_met.SWdown == 1, inplace=True)
-    #df_met.where(df_met.Tair_qc == 1, inplace=True)
-
-    # Mask dew
-    df_met.where(df_flx.Qle > 0., inplace=True)
-    df_flx.where(df_flx.Qle > 0., inplace=True)
+    # Mask crap stuff and dew, see qc.POLICIES
+    good = qc_mask(pack_qc(df_flx, df_met), "ozflux_fluxes")
+    df_flx = df_flx.where(good)
+    df_met = df_met.where(good)
 
     df_flx.dropna(inplace=True)
     df_met.dropna(inplace=True)
@@ -144,24 +136,28 @@ def make_plot(plot_dir, site, df_flx, df_met):
         df_flx = df_flx.between_time("09:00", "13:00")
         df_met = df_met.between_time("09:00", "13:00")
 
+        # All four fits at once, spread over nworkers. With search="adaptive"
+        # lambda is searched for from the last site's, see gam_fit.search_lams
+        jobs = {("SWdown", "Qle"): (df_met.SWdown, df_flx.Qle),
+                ("SWdown", "Qh"): (df_met.SWdown, df_flx.Qh),
+                ("Tair", "Qle"): (df_met.Tair - K_TO_C, df_flx.Qle),
+                ("Tair", "Qh"): (df_met.Tair - K_TO_C, df_flx.Qh)}
+        gams = fit_gams(jobs, nworkers=nworkers, search=search)
+
         ax1.plot(df_met.SWdown, df_flx.Qle, ls=" ", marker=".", mec="#FF0000",
                  color="#FF0000", alpha=alpha)
         ax1.plot(df_met.SWdown, df_flx.Qh, ls=" ", marker=".", mec="royalblue",
                  color="royalblue", alpha=alpha)
 
-        gam = LinearGAM(n_splines=20).gridsearch(df_met.SWdown, df_flx.Qle)
-        XX = generate_X_grid(gam)
-        CI = gam.confidence_intervals(XX, width=.95)
-
-        ax1.plot(XX, gam.predict(XX), color="#FF0000", ls='-', lw=2.0,
-                 label="Qle")
+        # Qle and Qh on one grid of each predictor
+        (qle, qh) = predict_grid([gams[("SWdown", "Qle")],
+                                  gams[("SWdown", "Qh")]])
+        (XX, pred, CI) = qle
+        ax1.plot(XX, pred, color="#FF0000", ls='-', lw=2.0, label="Qle")
         ax1.fill_between(XX[:,0], CI[:,0], CI[:,1], color='salmon', alpha=0.7)
 
-        gam = LinearGAM(n_splines=20).gridsearch(df_met.SWdown, df_flx.Qh)
-        XX = generate_X_grid(gam)
-        CI = gam.confidence_intervals(XX, width=.95)
-        ax1.plot(XX, gam.predict(XX), color="royalblue", ls='-', lw=2.0,
-                 label="Qh")
+        (XX, pred, CI) = qh
+        ax1.plot(XX, pred, color="royalblue", ls='-', lw=2.0, label="Qh")
         ax1.fill_between(XX[:,0], CI[:,0], CI[:,1], color='CornflowerBlue',
                          alpha=0.7)
 
@@ -170,18 +166,14 @@ def make_plot(plot_dir, site, df_flx, df_met):
         ax2.plot(df_met.Tair - K_TO_C, df_flx.Qh, ls=" ", marker=".",
                  color="royalblue", alpha=alpha, mec="royalblue")
 
-        gam = LinearGAM(n_splines=20).gridsearch(df_met.Tair - K_TO_C,
-                                                 df_flx.Qle)
-        XX = generate_X_grid(gam)
-        CI = gam.confidence_intervals(XX, width=.95)
-        ax2.plot(XX, gam.predict(XX), color="#FF0000", ls='-', lw=2.0)
+        (qle, qh) = predict_grid([gams[("Tair", "Qle")],
+                                  gams[("Tair", "Qh")]])
+        (XX, pred, CI) = qle
+        ax2.plot(XX, pred, color="#FF0000", ls='-', lw=2.0)
         ax2.fill_between(XX[:,0], CI[:,0], CI[:,1], color='salmon', alpha=0.7)
 
-        gam = LinearGAM(n_splines=20).gridsearch(df_met.Tair - K_TO_C,
-                                                 df_flx.Qh)
-        XX = generate_X_grid(gam)
-        CI = gam.confidence_intervals(XX, width=.95)
-        ax2.plot(XX, gam.predict(XX), color="royalblue", ls='-', lw=2.0)
+        (XX, pred, CI) = qh
+        ax2.plot(XX, pred, color="royalblue", ls='-', lw=2.0)
         ax2.fill_between(XX[:,0], CI[:,0], CI[:,1], color='CornflowerBlue',
                          alpha=0.7)
         plt.setp(ax2.get_yticklabels(), visible=False)
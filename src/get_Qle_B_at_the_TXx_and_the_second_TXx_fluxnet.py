@@ -21,6 +21,7 @@ import matplotlib.pyplot as plt
 import pandas as pd
 
 import constants as c
+from day_grid import DayGrid
 
 def main(flux_dir, ofname, oz_flux=True):
 
@@ -77,14 +78,16 @@ def main(flux_dir, ofname, oz_flux=True):
 def get_hottest_day(df_flx, df_met):
 
     TXx = df_met.sort_values("Tair", ascending=False)[:1].Tair.values[0]
-    year = df_met.sort_values("Tair", ascending=False)[:1].index.year[0]
-    doy = df_met.sort_values("Tair", ascending=False)[:1].index.dayofyear[0]
+    TXx_day = df_met.sort_values("Tair", ascending=False)[:1].index[0]
 
+    # Diurnal cycles are the rows of the [day, timestep] grid
+    grid = DayGrid(df_flx.index)
+    hours = np.arange(grid.nsteps) * grid.timestep / 3600.
+    Qle = grid.layout(df_flx.Qle.values)
+    day = grid.days.get_loc(TXx_day.normalize())
     for i in range(0,5, 4):
         print(i)
-        Qle = df_flx[(df_flx.index.year == year) & (df_flx.index.dayofyear == doy-i)].Qle
-
-        plt.plot(Qle.index.hour, Qle)
+        plt.plot(hours, Qle[day-i])
     plt.show()
     sys.exit()
     TXx_idx_minus_four= TXx_idx - pd.Timedelta(4, unit='d')
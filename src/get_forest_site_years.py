@@ -20,6 +20,7 @@ import xarray as xr
 import matplotlib.pyplot as plt
 
 import constants as c
+from flux_io import get_manifest
 
 def main(flux_dir):
 
@@ -42,15 +43,12 @@ def main(flux_dir):
     if not os.path.exists(plot_dir):
         os.makedirs(plot_dir)
 
-    flux_files = sorted(glob.glob(os.path.join(flux_dir, "*_flux.nc")))
-    met_files = sorted(glob.glob(os.path.join(flux_dir, "*_met.nc")))
+    # Site, PFT and years all come from the file headers
+    manifest = get_manifest(flux_dir, oz_flux=True, pfts=d)
+    manifest = manifest[manifest.pft == "EBF"]
 
-    for flux_fn, met_fn in zip(flux_files, met_files):
-        (site, df_flx, df_met) = open_file(flux_fn, met_fn)
-        #print(site)
-        # Mask crap stuff
-        if d[site] == "EBF":
-            print(site, np.unique(df_flx.index.year))
+    for row in manifest.itertuples():
+        print(row.site, np.arange(row.start.year, row.end.year + 1))
 
 def get_three_most_hottest_weeks(df):
     df_w = df.resample("W").mean()
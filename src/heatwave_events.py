@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""
+Pick heatwave windows out of a daily record.
+
+The daily maxima are sorted once (hottest first) and the days that have been
+used up, either because they belong to an event we've already taken or to a
+window we've rejected, are flagged in an exclusion bitmap. Asking for the next
+hottest day is then just a walk along the sorted order, skipping flagged days,
+rather than a re-sort of what is left of the daily frames.
+
+The number of valid days in each series is held as a running count
+(WindowStats), so the count over any window, of any length, is a difference of
+two entries and the same daily record can be searched with several window
+lengths without recomputing anything. Sums (e.g. rain, screened against a
+0.2 mm threshold) are taken over the few days of the window itself, as a
+difference of running float totals drifts over a decade of record and flips
+that test.
+
+Days are addressed by their position on the daily grid (DayIndex), so a window
+is a contiguous slice of each series rather than a date mask over the frame.
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import numpy as np
+
+
+class DayIndex(object):
+    """ Maps dates to positions on the daily grid and back """
+
+    def __init__(self, dates):
+        self.days = np.asarray(dates, dtype="datetime64[D]")
+        self.ndays = len(self.days)
+
+        # On a regular grid (i.e. anything out of resample("D")) a date's
+        # position is just the number of days since the start
+        if self.ndays > 0:
+            span = (self.days[-1] - self.days[0]).astype(np.int64)
+            self.regular = (span == self.ndays - 1 and
+                            np.all(np.diff(self.days).astype(np.int64) == 1))
+        else:
+            self.regular = True
+
+    def offset(self, date):
+        """ Position of date on the grid """
+        return int(self.offsets(date))
+
+    def offsets(self, dates):
+        """ Positions of an array of dates on the grid """
+        days = np.asarray(dates, dtype="datetime64[D]")
+        if self.regular:
+            return (days - self.days[0]).astype(np.int64)
+
+        return np.searchsorted(self.days, days)
+
+    def date(self, idx):
+        """ Date at position idx """
+        return self.days[idx]
+
+    def start(self, idx, window):
+        """ Position of the first day of the window that ends on idx """
+        if self.regular:
+            return np.maximum(idx - window + 1, 0)
+
+        return np.searchsorted(self.days, self.days[idx] - (window - 1))
+
+    def window(self, idx, window):
+        """ Slice covering the window that ends on idx """
+        return slice(int(self.start(idx, window)), idx + 1)
+
+
+class WindowStats(object):
+    """ Daily series and running counts of their valid days """
+
+    def __init__(self, days=None, **series):
+        self.days = days
+        self.values = {}
+        self.counts = {}
+
+        for name, x in series.items():
+            x = np.asarray(x, dtype=np.float64)
+            self.values[name] = x
+            self.counts[name] = np.concatenate(([0],
+                                                np.cumsum(np.isfinite(x))))
+            self.ndays = len(x)
+
+        if self.days is None:
+            self.days = DayIndex(np.arange(self.ndays).astype("datetime64[D]"))
+
+    def total(self, name, idx, window):
+        """ Sum over the window ending on idx, ignoring missing days """
+        return np.nansum(self.window(name, idx, window))
+
+    def count(self, name, idx, window):
+        """ Number of days with data in the window ending on idx """
+        lo = self.days.start(idx, window)
+        return self.counts[name][idx + 1] - self.counts[name][lo]
+
+    def window(self, name, idx, window):
+        """ Daily values in the window ending on idx (a view, not a copy) """
+        return self.values[name][self.days.window(idx, window)]
+
+
+class EventSelector(object):
+    """ Hottest-first walk over the days, window ends on the candidate day """
+
+    def __init__(self, stats, window=4):
+        self.stats = stats
+        self.tair = stats.values["Tair"]
+        self.window = window
+        self.ndays = len(self.tair)
+
+        # Descending, with NaN days last; ties are taken in date order
+        self.order = np.argsort(-self.tair, kind="mergesort")
+        self.excluded = np.zeros(self.ndays, dtype=bool)
+        self.nleft = self.ndays
+        self.pos = 0
+
+    def start(self, idx):
+        """ First day of the window that ends on day idx """
+        return int(self.stats.days.start(idx, self.window))
+
+    def hottest(self):
+        """ Index of the hottest day still in play, None once we run out """
+        while self.pos < self.ndays and self.excluded[self.order[self.pos]]:
+            self.pos += 1
+
+        if self.pos == self.ndays:
+            return None
+
+        return self.order[self.pos]
+
+    def drop(self, idx):
+        """ Take the window ending on day idx out of play """
+        s = slice(self.start(idx), idx + 1)
+        self.nleft -= np.count_nonzero(~self.excluded[s])
+        self.excluded[s] = True
+
+    def is_long_enough(self, idx):
+        """ Does the window ending on idx have all its days still in play? """
+        lo = self.start(idx)
+        return (idx - lo + 1 == self.window and
+                not self.excluded[lo:idx + 1].any())
+
+    def is_dry(self, idx, threshold):
+        """ Did it rain no more than threshold (mm) over the window? """
+        return self.stats.total("rain", idx, self.window) <= threshold
+
+    def is_complete(self, idx):
+        """ Did every day in the window have a valid Tair? """
+        return self.stats.count("Tair", idx, self.window) == self.window
+
+
+def find_events(sel, tthresh=37.0, rain_threshold=0.2):
+    """
+    Walk the days hottest first and pull out the heatwave windows.
+
+    Returns the TXx, the day the TXx event ends on (None if we couldn't find
+    one) and the end days of every other complete, dry event above tthresh
+    (deg C). Note the TXx event is whatever is_event_long_enough settles on,
+    it isn't screened for missing days or held to tthresh here.
+    """
+    TXx_idx = sel.hottest()
+    TXx = sel.tair[TXx_idx]
+    first_idx = is_event_long_enough(sel, TXx_idx, rain_threshold)
+
+    # Drop the hottest event as we've already got it
+    sel.drop(TXx_idx)
+    TXx_idx = sel.hottest()
+
+    event_idxs = []
+    while TXx_idx is not None and sel.tair[TXx_idx] > tthresh:
+
+        event_idx = is_event_long_enough(sel, TXx_idx, rain_threshold)
+
+        # Only keep events where we've got all the days after QA
+        if event_idx is not None and sel.is_complete(event_idx):
+            event_idxs.append(event_idx)
+
+        # Drop this event, then get next TXx
+        sel.drop(TXx_idx)
+        TXx_idx = sel.hottest()
+
+    return (TXx, first_idx, event_idxs)
+
+def is_event_long_enough(sel, TXx_idx, rain_threshold=0.2):
+    """ Return the day the accepted event ends on, None if there isn't one """
+
+    while TXx_idx is not None and not sel.is_long_enough(TXx_idx):
+
+        # Drop this event as it wasn't long enough
+        sel.drop(TXx_idx)
+        TXx_idx = sel.hottest()
+
+        if TXx_idx is not None:
+            TXx_idx = check_for_rain(sel, TXx_idx, rain_threshold)
+
+        if sel.nleft <= sel.window:
+            TXx_idx = None
+
+    return TXx_idx
+
+def check_for_rain(sel, TXx_idx, threshold=0.2):
+    """ threshold is in mm d-1; arbitary, we can refine. """
+
+    while (not sel.is_dry(TXx_idx, threshold) or
+           not sel.is_long_enough(TXx_idx)):
+
+        # Drop this event as there was some rain or we didn't get enough
+        # good QA days
+        sel.drop(TXx_idx)
+        TXx_idx = sel.hottest()
+
+        if TXx_idx is None or sel.nleft <= sel.window:
+            return None
+
+    return TXx_idx
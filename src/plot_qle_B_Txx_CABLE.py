@@ -21,6 +21,8 @@ import matplotlib.pyplot as plt
 import pandas as pd
 
 import constants as c
+from qc import pack_qc, qc_mask
+from heatwave_events import DayIndex
 
 def main(flux_dir, cable_dir):
 
@@ -118,48 +120,24 @@ def get_hottest_day(df_mod, df_met):
     df_df = df_mod.resample("D").mean()
 
     Txx_idx = df_dm.sort_values("Tair", ascending=False)[:1].index.values[0]
-    Txx_idx_minus_five = Txx_idx - pd.Timedelta(4, unit='d')
 
+    # TXx day and the four days before it, as a slice on the daily grid
+    days = DayIndex(df_dm.index)
+    window = days.window(days.offset(Txx_idx), 5)
 
-
-    Tairs = df_dm[(df_dm.index >= Txx_idx_minus_five) &
-                 (df_dm.index <= Txx_idx)].Tair.values
-    Qles = df_df[(df_dm.index >= Txx_idx_minus_five) &
-                 (df_dm.index <= Txx_idx)].Qle.values
-    Qhs = df_df[(df_dm.index >= Txx_idx_minus_five) &
-                 (df_dm.index <= Txx_idx)].Qh.values
+    Tairs = df_dm.Tair.values[window]
+    Qles = df_df.Qle.values[window]
+    Qhs = df_df.Qh.values[window]
     B = Qhs / Qles
 
     return(Tairs, Qles, B)
 
 
 def mask_crap_days(df_mod, df_flx, df_met):
-    # Mask crap stuff
-    df_flx.where(df_flx.Qle_qc == 1, inplace=True)
-    df_flx.where(df_flx.Qh_qc == 1, inplace=True)
-    df_flx.where(df_met.Tair_qc == 1, inplace=True)
-
-    df_mod.where(df_flx.Qle_qc == 1, inplace=True)
-    df_mod.where(df_flx.Qh_qc == 1, inplace=True)
-    df_mod.where(df_met.Tair_qc == 1, inplace=True)
-
-    df_met.where(df_flx.Qle_qc == 1, inplace=True)
-    df_met.where(df_flx.Qh_qc == 1, inplace=True)
-    df_met.where(df_met.Tair_qc == 1, inplace=True)
-
-    # Mask dew
-    df_met.where(df_flx.Qle > 0., inplace=True)
-    df_mod.where(df_flx.Qle > 0., inplace=True)
-    df_flx.where(df_flx.Qle > 0., inplace=True)
-
-    df_met = df_met.reset_index()
-    df_met = df_met.set_index('time')
-    df_flx = df_flx.reset_index()
-    df_flx = df_flx.set_index('time')
-    df_mod = df_mod.reset_index()
-    df_mod = df_mod.set_index('time')
+    # Mask crap stuff and dew, one combined mask applied once to each frame
+    good = qc_mask(pack_qc(df_flx, df_met), "ozflux")
 
-    return df_mod, df_flx, df_met
+    return df_mod.where(good), df_flx.where(good), df_met.where(good)
 
 def open_file(cable_fn, flux_fn, met_fn):
     site = os.path.basename(flux_fn).split("OzFlux")[0]
@@ -28,10 +28,12 @@ import xarray as xr
 import matplotlib.pyplot as plt
 import pandas as pd
 
-from pygam import LinearGAM
-from pygam.utils import generate_X_grid
 
-def main(flux_dir):
+from qc import pack_qc, qc_mask
+from gam_fit import fit_gams, predict_grid
+from day_grid import DayGrid, MIDDAY
+
+def main(flux_dir, nworkers=1, search="grid"):
 
     sites = ["AdelaideRiver","Calperum","CapeTribulation","CowBay",\
              "CumberlandPlains","DalyPasture","DalyUncleared",\
@@ -61,8 +63,9 @@ def main(flux_dir):
     for flux_fn, met_fn in zip(flux_files, met_files):
         (site, df_flx, df_met) = open_file(flux_fn, met_fn)
         print(site)
-        if d[site] != "NA"
-            make_plot(plot_dir, site, df_flx, df_met, d[site], f)
+        if d[site] != "NA":
+            make_plot(plot_dir, site, df_flx, df_met, d[site], f,
+                      nworkers=nworkers, search=search)
 
     f.close()
 
@@ -82,7 +85,8 @@ def open_file(flux_fn, met_fn):
 
     return (site, df_flx, df_met)
 
-def make_plot(plot_dir, site, df_flx, df_met, pft, fp):
+def make_plot(plot_dir, site, df_flx, df_met, pft, fp, nworkers=1,
+              search="grid"):
 
     K_TO_C = 273.15
 
@@ -118,75 +122,72 @@ def make_plot(plot_dir, site, df_flx, df_met, pft, fp):
     ax1 = fig.add_subplot(121)
     ax2 = fig.add_subplot(122)
 
-    # Mask crap stuff
-    df_met.where(df_flx.Qle_qc == 1, inplace=True)
-    df_met.where(df_flx.Qh_qc == 1, inplace=True)
-
-    df_flx.where(df_flx.Qle_qc == 1, inplace=True)
-    df_flx.where(df_flx.Qh_qc == 1, inplace=True)
-    #df_flx.where(df_met.Tair_qc == 1, inplace=True)
-    #df_flx.where(df_met.SWdown == 1, inplace=True)
+    # Mask crap stuff and dew, see qc.POLICIES
+    good = qc_mask(pack_qc(df_flx, df_met), "ozflux_fluxes")
+    df_flx = df_flx.where(good)
+    df_met = df_met.where(good)
 
-    #df_met.where(df_met.SWdown == 1, inplace=True)
-    #df_met.where(df_met.Tair_qc == 1, inplace=True)
+    # Only timesteps with every flux and every met column, as dropping the
+    # missing rows from each frame did
+    df_met = df_met.reindex(df_flx.index)
+    keep = df_flx.notna().all(axis=1) & df_met.notna().all(axis=1)
 
-    # Mask dew
-    df_met.where(df_flx.Qle > 0., inplace=True)
-    df_flx.where(df_flx.Qle > 0., inplace=True)
+    # < "Midday" data, a slice of columns of the [day, timestep] grid
+    grid = DayGrid(df_flx.index)
+    midday = grid.hours(MIDDAY)
+    cols = {"SWdown": df_met.SWdown, "Qle": df_flx.Qle, "Qh": df_flx.Qh,
+            "Tair": df_met.Tair}
+    df = pd.DataFrame({col: grid.layout(x.where(keep).values)[:, midday]
+                       .ravel() for col, x in cols.items()}).dropna()
 
-    df_flx.dropna(inplace=True)
-    df_met.dropna(inplace=True)
 
-
-    if len(df_flx) > 0 and len(df_met) > 0:
-        print(site, len(df_flx), len(df_met))
+    if len(df) > 0:
+        print(site, len(df))
 
         alpha = 0.07
 
-        # < "Midday" data
-        df_flx = df_flx.between_time("09:00", "13:00")
-        df_met = df_met.between_time("09:00", "13:00")
+        # All four fits at once, spread over nworkers. With search="adaptive"
+        # lambda is searched for from the last site's, see gam_fit.search_lams
+        jobs = {("SWdown", "Qle"): (df.SWdown, df.Qle),
+                ("SWdown", "Qh"): (df.SWdown, df.Qh),
+                ("Tair", "Qle"): (df.Tair - K_TO_C, df.Qle),
+                ("Tair", "Qh"): (df.Tair - K_TO_C, df.Qh)}
+        gams = fit_gams(jobs, nworkers=nworkers, search=search)
 
-        ax1.plot(df_met.SWdown, df_flx.Qle, ls=" ", marker="o",
+        ax1.plot(df.SWdown, df.Qle, ls=" ", marker="o",
                  color="salmon", alpha=alpha)
-        ax1.plot(df_met.SWdown, df_flx.Qh, ls=" ", marker="o",
+        ax1.plot(df.SWdown, df.Qh, ls=" ", marker="o",
                  color="royalblue", alpha=alpha)
 
-        gam = LinearGAM(n_splines=20).gridsearch(df_met.SWdown, df_flx.Qle)
-        XX = generate_X_grid(gam)
-        ax1.plot(XX, gam.predict(XX), color="salmon", ls='-', lw=2.0,
-                 label="Qle")
-        ax1.plot(XX, gam.prediction_intervals(XX, width=.95), color='salmon',
-                 ls='--')
-
-        for ii in range(len(df_met)):
-            print("%f,%f,%f,%f,%s" % (df_met.SWdown[ii], df_flx.Qle[ii],\
-                                      df_flx.Qh[ii], df_met.Tair[ii] - K_TO_C,\
-                                      pft), file=fp)
-
-        gam = LinearGAM(n_splines=20).gridsearch(df_met.SWdown, df_flx.Qh)
-        XX = generate_X_grid(gam)
-        ax1.plot(XX, gam.predict(XX), color="royalblue", ls='-', lw=2.0,
-                 label="Qh")
-        ax1.plot(XX, gam.prediction_intervals(XX, width=.95), color='royalblue',
-                 ls='--')
-
-        ax2.plot(df_met.Tair - K_TO_C, df_flx.Qle, ls=" ", marker="o",
+        # Qle and Qh on one grid of each predictor
+        (qle, qh) = predict_grid([gams[("SWdown", "Qle")],
+                                  gams[("SWdown", "Qh")]], prediction=True)
+        (XX, pred, PI) = qle
+        ax1.plot(XX, pred, color="salmon", ls='-', lw=2.0, label="Qle")
+        ax1.plot(XX, PI, color='salmon', ls='--')
+
+        for row in df.itertuples():
+            print("%f,%f,%f,%f,%s" % (row.SWdown, row.Qle, row.Qh,\
+                                      row.Tair - K_TO_C, pft), file=fp)
+
+        (XX, pred, PI) = qh
+        ax1.plot(XX, pred, color="royalblue", ls='-', lw=2.0, label="Qh")
+        ax1.plot(XX, PI, color='royalblue', ls='--')
+
+        ax2.plot(df.Tair - K_TO_C, df.Qle, ls=" ", marker="o",
                  color="salmon", alpha=alpha, label="Qle")
-        ax2.plot(df_met.Tair - K_TO_C, df_flx.Qh, ls=" ", marker="o",
+        ax2.plot(df.Tair - K_TO_C, df.Qh, ls=" ", marker="o",
                  color="royalblue", alpha=alpha, label="Qh")
 
-        gam = LinearGAM(n_splines=20).gridsearch(df_met.Tair - K_TO_C, df_flx.Qle)
-        XX = generate_X_grid(gam)
-        ax2.plot(XX, gam.predict(XX), color="salmon", ls='-', lw=2.0)
-        ax2.plot(XX, gam.prediction_intervals(XX, width=.95), color='salmon',
-                 ls='--')
-
-        gam = LinearGAM(n_splines=20).gridsearch(df_met.Tair - K_TO_C, df_flx.Qh)
-        XX = generate_X_grid(gam)
-        ax2.plot(XX, gam.predict(XX), color="royalblue", ls='-', lw=2.0)
-        ax2.plot(XX, gam.prediction_intervals(XX, width=.95), color='royalblue',
-                 ls='--')
+        (qle, qh) = predict_grid([gams[("Tair", "Qle")],
+                                  gams[("Tair", "Qh")]], prediction=True)
+        (XX, pred, PI) = qle
+        ax2.plot(XX, pred, color="salmon", ls='-', lw=2.0)
+        ax2.plot(XX, PI, color='salmon', ls='--')
+
+        (XX, pred, PI) = qh
+        ax2.plot(XX, pred, color="royalblue", ls='-', lw=2.0)
+        ax2.plot(XX, PI, color='royalblue', ls='--')
         plt.setp(ax2.get_yticklabels(), visible=False)
 
         ax1.set_xlim(0, 1300)